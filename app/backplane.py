@@ -0,0 +1,152 @@
+import asyncio
+import logging
+from typing import Any, Callable
+
+import asyncpg
+import orjson
+from sqlalchemy import func, select
+
+from .config import settings
+from .db import async_engine
+
+logger = logging.getLogger(__name__)
+
+# Postgres rejects NOTIFY payloads of 8000 bytes or more.
+NOTIFY_PAYLOAD_LIMIT = 7999
+
+Envelope = dict[str, Any]
+Deliver = Callable[[Envelope], None]
+
+
+class InProcessBackplane:
+    """Delivers broadcasts to the subscribers of the current process only."""
+
+    def __init__(self):
+        self.deliver: Deliver | None = None
+
+    async def start(self, deliver: Deliver):
+        self.deliver = deliver
+
+    async def stop(self):
+        self.deliver = None
+
+    def publish(self, envelope: Envelope):
+        if self.deliver is not None:
+            self.deliver(envelope)
+
+
+class PostgresBackplane:
+    """Fans broadcasts out to every process through Postgres LISTEN/NOTIFY.
+
+    Each process keeps one dedicated listener connection and delivers what it
+    receives, its own broadcasts included, to its local subscribers.
+    Outgoing envelopes are batched into as few NOTIFY payloads as possible.
+    An envelope that cannot fit in a payload on its own is replaced by a
+    `resync` notice telling subscribers to fetch the poll again. While the
+    listener is down, or when publishing fails, broadcasts are delivered
+    locally so that at least this process's subscribers keep getting them.
+    """
+
+    def __init__(self, channel: str, batch_ms: int):
+        self.channel = channel
+        self.batch_interval = batch_ms / 1000
+        self.deliver: Deliver | None = None
+        self.listening = False
+        self.outbox: list[Envelope] = []
+        self._wakeup = asyncio.Event()
+        self._tasks: list[asyncio.Task] = []
+
+    async def start(self, deliver: Deliver):
+        self.deliver = deliver
+        self._wakeup = asyncio.Event()
+        self._tasks = [
+            asyncio.create_task(self._listen()),
+            asyncio.create_task(self._publish_loop()),
+        ]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self.deliver = None
+
+    def publish(self, envelope: Envelope):
+        if not self.listening:
+            self._deliver(envelope)
+            return
+        self.outbox.append(envelope)
+        self._wakeup.set()
+
+    def _deliver(self, envelope: Envelope):
+        if self.deliver is not None:
+            self.deliver(envelope)
+
+    def _payloads(self, envelopes: list[Envelope]):
+        batch: list[bytes] = []
+        size = 2
+        for envelope in envelopes:
+            encoded = orjson.dumps(envelope, option=orjson.OPT_NON_STR_KEYS)
+            if len(encoded) + 2 > NOTIFY_PAYLOAD_LIMIT:
+                encoded = orjson.dumps({"p": envelope["p"], "t": "resync"})
+            if batch and size + len(encoded) + 1 > NOTIFY_PAYLOAD_LIMIT:
+                yield (b"[" + b",".join(batch) + b"]").decode()
+                batch, size = [], 2
+            batch.append(encoded)
+            size += len(encoded) + 1
+        if batch:
+            yield (b"[" + b",".join(batch) + b"]").decode()
+
+    async def _publish_loop(self):
+        while True:
+            await self._wakeup.wait()
+            # Let the envelopes of concurrent requests join the batch.
+            await asyncio.sleep(self.batch_interval)
+            self._wakeup.clear()
+            envelopes, self.outbox = self.outbox, []
+            try:
+                async with async_engine.begin() as connection:
+                    for payload in self._payloads(envelopes):
+                        await connection.execute(
+                            select(func.pg_notify(self.channel, payload))
+                        )
+            except Exception:
+                logger.exception("Failed to publish broadcasts, delivering locally")
+                for envelope in envelopes:
+                    self._deliver(envelope)
+
+    async def _listen(self):
+        while True:
+            connection: asyncpg.Connection | None = None
+            try:
+                connection = await asyncpg.connect(
+                    user=settings.postgres_user,
+                    password=settings.postgres_password,
+                    host=settings.postgres_host,
+                    port=settings.postgres_port,
+                    database=settings.postgres_db,
+                )
+                terminated = asyncio.Event()
+                connection.add_termination_listener(lambda _: terminated.set())
+                await connection.add_listener(self.channel, self._on_notification)
+                self.listening = True
+                await terminated.wait()
+            except Exception:
+                logger.exception("Broadcast listener failed, reconnecting")
+            finally:
+                self.listening = False
+                if connection is not None and not connection.is_closed():
+                    await connection.close()
+            await asyncio.sleep(1)
+
+    def _on_notification(self, connection, pid: int, channel: str, payload: str):
+        for envelope in orjson.loads(payload):
+            self._deliver(envelope)
+
+
+def create_backplane() -> InProcessBackplane | PostgresBackplane:
+    if settings.ws_backplane == "postgres":
+        return PostgresBackplane(
+            settings.ws_backplane_channel, settings.ws_backplane_batch_ms
+        )
+    return InProcessBackplane()
@@ -1,3 +1,5 @@
+from typing import Literal
+
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -10,6 +12,57 @@ class Settings(BaseSettings):
     postgres_host: str = "db"
     postgres_port: int = 5432
     jwt_secret: str
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    db_pool_timeout_seconds: float = 30
+    db_pool_recycle_seconds: int = -1
+    db_pool_pre_ping: bool = False
+    sql_repeat_threshold: int = 20
+    sql_repeat_action: Literal["off", "warn", "raise"] = "warn"
+    slow_query_log_enabled: bool = False
+    slow_query_threshold_ms: int = 200
+    slow_query_log_size: int = 100
+    slow_query_analyze_sample: float = 0.0
+    admin_emails: list[str] = []
+    # Buffered counters lose the unflushed deltas of a worker that dies. They
+    # are only recounted when a worker starts alone, never while others run.
+    vote_counter_mode: Literal["direct", "buffered", "striped"] = "direct"
+    vote_buffer_flush_interval_ms: int = 200
+    vote_buffer_max_pending: int = 1000
+    vote_counter_slots: int = 16
+    vote_counter_cache_ttl_ms: int = 500
+    vote_reconcile_enabled: bool = True
+    vote_reconcile_interval_ms: int = 1000
+    vote_reconcile_chunk_size: int = 500
+    vote_reconcile_scan_size: int = 10000
+    vote_reconcile_recheck_ms: int = 30000
+    vote_rollup_interval_ms: int = 5000
+    vote_rollup_lag_seconds: int = 120
+    user_cache_size: int = 10000
+    user_cache_ttl_seconds: float = 30
+    poll_cache_size: int = 10000
+    poll_cache_max_bytes: int = 64 * 1024 * 1024
+    poll_cache_ttl_seconds: float = 2
+    poll_version_interval_ms: int = 500
+    poll_version_scan_size: int = 10000
+    poll_import_batch_size: int = 1000
+    vote_export_batch_size: int = 5000
+    vote_batch_max_size: int = 500
+    password_hashing_executor: Literal["thread", "process"] = "thread"
+    password_hashing_workers: int = 4
+    password_hashing_max_waiting: int = 64
+    password_hashing_queue_timeout_ms: int = 1000
+    ws_queue_size: int = 64
+    ws_slow_consumer_policy: Literal["drop_oldest", "coalesce", "disconnect"] = (
+        "drop_oldest"
+    )
+    ws_send_timeout_ms: int = 5000
+    ws_delta_tick_ms: int = 100
+    ws_backplane: Literal["memory", "postgres"] = "memory"
+    ws_backplane_channel: str = "voting_app_broadcasts"
+    ws_backplane_batch_ms: int = 10
+    ws_hot_polls_top_k: int = 10
+    ws_hot_polls_window_seconds: float = 60
 
 
 settings = Settings()  # pyright: ignore[reportGeneralTypeIssues]
@@ -0,0 +1,273 @@
+import asyncio
+import logging
+import time
+from typing import Iterable, Sequence, cast
+
+from sqlalchemy import Integer, column, delete, func, select, update, values
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .config import settings
+from .db import AdvisoryLock, AsyncSessionLocal, try_lock_xact
+from .schemas import Option, OptionVoteSlot, Poll, Vote
+
+logger = logging.getLogger(__name__)
+
+
+async def _bump_versions(session: AsyncSession, poll_ids: set[int]):
+    """Bump the versions of polls whose counters changed in this transaction."""
+    if not poll_ids:
+        return
+    # Locked in id order like `bump_versions`, which cannot be imported here.
+    locked = (
+        select(Poll.id)
+        .where(Poll.id.in_(poll_ids))
+        .order_by(Poll.id)
+        .with_for_update()
+        .cte("locked")
+    )
+    await session.execute(
+        update(Poll).where(Poll.id == locked.c.id).values(version=Poll.version + 1)
+    )
+
+
+class VoteCounterBuffer:
+    """Write-behind buffer for `Option.votes_count`.
+
+    Vote rows are still written synchronously, only the denormalised counter
+    updates are accumulated in memory and flushed in batches. Because `votes`
+    stays the source of truth, `recount` rebuilds every counter on startup,
+    which repairs any deltas lost when a worker dies before flushing.
+
+    A recount would overwrite the unflushed deltas of the other workers, so
+    every buffering worker holds a shared advisory lock and the recount only
+    runs when it gets the same lock exclusively, that is when it starts
+    alone. Deltas lost by a worker dying while others keep running are
+    therefore only repaired once all workers restart, and the reconciler
+    cannot help as it does not see the deltas buffered elsewhere.
+
+    Poll versions are bumped in the transaction that writes the counters,
+    never from the vote path, so a version never labels counts older than
+    itself.
+    """
+
+    def __init__(self, flush_interval_ms: int, max_pending: int):
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_pending = max_pending
+        self.pending: dict[int, int] = {}
+        self.flushing: dict[int, int] = {}
+        self.pending_events = 0
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._flush: asyncio.Future | None = None
+        self.buffering = AdvisoryLock("vote_counter_buffer", shared=True)
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def add(self, option_id: int, delta: int):
+        self.pending[option_id] = self.pending.get(option_id, 0) + delta
+        self.pending_events += 1
+        if self.pending_events >= self.max_pending:
+            self._wakeup.set()
+
+    def total(self, option_id: int, stored: int) -> int:
+        """Running total of an option given the value stored in the database."""
+        return (
+            stored + self.pending.get(option_id, 0) + self.flushing.get(option_id, 0)
+        )
+
+    async def recount(self) -> bool:
+        """Rebuild every counter from the votes, unless other workers buffer.
+
+        Returns whether the counters were rebuilt.
+        """
+        counts = (
+            select(Vote.option_id, func.count().label("votes_count"))
+            .group_by(Vote.option_id)
+            .subquery()
+        )
+        async with AsyncSessionLocal() as session:
+            if not await try_lock_xact(session, self.buffering.name):
+                return False
+            counted = func.coalesce(
+                select(counts.c.votes_count)
+                .where(counts.c.option_id == Option.id)
+                .scalar_subquery(),
+                0,
+            )
+            poll_ids = await session.scalars(
+                update(Option)
+                .where(Option.votes_count != counted)
+                .values(votes_count=counted)
+                .returning(Option.poll_id)
+            )
+            await _bump_versions(session, set(poll_ids))
+            await session.commit()
+        return True
+
+    async def flush(self):
+        self.flushing, self.pending = self.pending, {}
+        self.pending_events = 0
+        changes = [item for item in self.flushing.items() if item[1] != 0]
+        if not changes:
+            self.flushing = {}
+            return
+        deltas = values(
+            column("option_id", Integer), column("delta", Integer), name="deltas"
+        ).data(changes)
+        try:
+            async with AsyncSessionLocal() as session:
+                poll_ids = await session.scalars(
+                    update(Option)
+                    .where(Option.id == deltas.c.option_id)
+                    .values(votes_count=Option.votes_count + deltas.c.delta)
+                    .returning(Option.poll_id)
+                )
+                await _bump_versions(session, set(poll_ids))
+                await session.commit()
+                # Stored from here on, `total` must not add them twice while
+                # the session closes.
+                self.flushing = {}
+        except Exception:
+            logger.exception("Failed to flush vote counters, retrying later")
+            for option_id, delta in self.flushing.items():
+                self.pending[option_id] = self.pending.get(option_id, 0) + delta
+            self.flushing = {}
+
+    async def start(self):
+        if not await self.recount():
+            logger.info("Other workers buffer vote counters, skipped the recount")
+        # Held as long as this worker may hold unflushed deltas.
+        await self.buffering.acquire(wait=True)
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        if self._flush is not None:
+            # Let a flush interrupted by the cancellation finish.
+            await self._flush
+            self._flush = None
+        try:
+            await self.flush()
+        finally:
+            await self.buffering.release()
+
+    async def _run(self):
+        while True:
+            # Unlike wait_for on 3.11, timeout() never swallows a cancellation
+            # that lands as the event is set, which would leave stop() hanging.
+            try:
+                async with asyncio.timeout(self.flush_interval):
+                    await self._wakeup.wait()
+            except TimeoutError:
+                pass
+            self._wakeup.clear()
+            # Shielded, so cancelling the loop never drops the deltas in flight.
+            self._flush = asyncio.ensure_future(self.flush())
+            await asyncio.shield(self._flush)
+
+
+def slot_sums(option_ids: Iterable[int]):
+    return (
+        select(OptionVoteSlot.option_id, func.sum(OptionVoteSlot.votes_count))
+        .where(OptionVoteSlot.option_id.in_(option_ids))
+        .group_by(OptionVoteSlot.option_id)
+    )
+
+
+class StripedCounters:
+    """Cached totals for options counted in `option_vote_slots`.
+
+    In striped mode every vote increments one of N slot rows of its option
+    instead of the option row itself, so concurrent voters rarely wait on the
+    same row lock. `Option.votes_count` is kept as the base the slots are
+    added to, which lets an existing counter switch modes without a recount.
+    """
+
+    def __init__(self, slots: int, cache_ttl_ms: int):
+        self.slots = slots
+        self.cache_ttl = cache_ttl_ms / 1000
+        self.cache: dict[int, tuple[float, int]] = {}
+
+    def record(self, option_id: int, total: int):
+        self.cache[option_id] = (time.monotonic() + self.cache_ttl, total)
+
+    def forget(self, option_id: int):
+        self.cache.pop(option_id, None)
+
+    async def totals(
+        self, session: AsyncSession, options: Sequence[Option], fresh: bool = False
+    ) -> dict[int, int]:
+        """Totals of the options, `fresh` ones never come from the cache."""
+        now = time.monotonic()
+        totals: dict[int, int] = {}
+        missing: dict[int, int] = {}
+        for option in options:
+            option_id = cast(int, option.id)
+            cached = self.cache.get(option_id)
+            if not fresh and cached is not None and cached[0] > now:
+                totals[option_id] = cached[1]
+            else:
+                missing[option_id] = cast(int, option.votes_count)
+        if missing:
+            sums = await session.execute(slot_sums(missing))
+            for option_id, slots_total in sums:
+                missing[option_id] += slots_total
+            for option_id, total in missing.items():
+                self.record(option_id, total)
+                totals[option_id] = total
+        return totals
+
+
+async def fold_vote_slots():
+    """Move striped increments back into `Option.votes_count`."""
+    slots = (
+        select(
+            OptionVoteSlot.option_id,
+            func.sum(OptionVoteSlot.votes_count).label("votes_count"),
+        )
+        .group_by(OptionVoteSlot.option_id)
+        .subquery()
+    )
+    async with AsyncSessionLocal() as session:
+        await session.execute(
+            update(Option)
+            .where(Option.id == slots.c.option_id)
+            .values(votes_count=Option.votes_count + slots.c.votes_count)
+        )
+        await session.execute(delete(OptionVoteSlot))
+        await session.commit()
+
+
+async def votes_counts(
+    session: AsyncSession, options: Sequence[Option], fresh: bool = False
+) -> dict[int, int]:
+    """Current vote count of every option, whatever the counter mode.
+
+    Counts served next to a poll version must be `fresh`, read after the
+    version, as striped totals may be cached from before it.
+    """
+    if settings.vote_counter_mode == "striped":
+        return await striped_counters.totals(session, options, fresh)
+    counts = {cast(int, option.id): cast(int, option.votes_count) for option in options}
+    if settings.vote_counter_mode == "buffered":
+        for option_id, stored in counts.items():
+            counts[option_id] = vote_counter_buffer.total(option_id, stored)
+    return counts
+
+
+vote_counter_buffer = VoteCounterBuffer(
+    settings.vote_buffer_flush_interval_ms, settings.vote_buffer_max_pending
+)
+striped_counters = StripedCounters(
+    settings.vote_counter_slots, settings.vote_counter_cache_ttl_ms
+)
@@ -1,6 +1,13 @@
-from sqlalchemy import create_engine
+import time
+
+from prometheus_client import Counter, Gauge, Histogram
+from sqlalchemy import create_engine, func, select
 from sqlalchemy.engine import URL
-from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import (AsyncConnection, AsyncSession,
+                                    async_sessionmaker, create_async_engine)
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 from .config import settings
 
@@ -12,8 +19,59 @@ database_url = URL.create(
     port=settings.postgres_port,
     database=settings.postgres_db,
 )
+async_database_url = database_url.set(drivername="postgresql+asyncpg")
+
+db_pool_checkout_seconds = Histogram(
+    "db_pool_checkout_seconds",
+    "Time spent getting a connection from the pool, connecting included",
+)
+db_pool_checkout_timeouts = Counter(
+    "db_pool_checkout_timeouts", "Checkouts that gave up after the pool timeout"
+)
+db_pool_waiting = Gauge("db_pool_waiting", "Checkouts waiting for a connection")
+db_pool_checked_out = Gauge("db_pool_checked_out", "Connections in use")
+db_pool_checked_in = Gauge("db_pool_checked_in", "Idle connections in the pool")
+db_pool_overflow = Gauge(
+    "db_pool_overflow", "Connections open beyond the pool size, up to max overflow"
+)
+
 
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """Queue pool that reports how long requests wait for a connection."""
+
+    waiting = 0
+
+    def _do_get(self):
+        InstrumentedPool.waiting += 1
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            db_pool_checkout_timeouts.inc()
+            raise
+        finally:
+            InstrumentedPool.waiting -= 1
+            db_pool_checkout_seconds.observe(time.perf_counter() - start)
+
+
+# The synchronous engine is only kept for the scripts, migrations build their
+# own from `database_url`; request handlers go through the async engine so
+# queries never block the event loop.
 engine = create_engine(database_url)
+async_engine = create_async_engine(
+    async_database_url,
+    poolclass=InstrumentedPool,
+    pool_size=settings.db_pool_size,
+    max_overflow=settings.db_max_overflow,
+    pool_timeout=settings.db_pool_timeout_seconds,
+    pool_recycle=settings.db_pool_recycle_seconds,
+    pool_pre_ping=settings.db_pool_pre_ping,
+)
+
+db_pool_waiting.set_function(lambda: InstrumentedPool.waiting)
+db_pool_checked_out.set_function(lambda: async_engine.pool.checkedout())
+db_pool_checked_in.set_function(lambda: async_engine.pool.checkedin())
+db_pool_overflow.set_function(lambda: max(async_engine.pool.overflow(), 0))
 
 
 Base = declarative_base()
@@ -21,8 +79,90 @@ base = Base()
 base_metadata = base.metadata
 
 
-def init_db():
-    Base.metadata.create_all(bind=engine)  # pyright: ignore[reportGeneralTypeIssues]
+async def init_db():
+    async with async_engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+
+
+# expire_on_commit is disabled because expired attributes would trigger lazy
+# loads, which are not possible outside of an awaitable context.
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, expire_on_commit=False)
+
+
+async def lock_xact(session: AsyncSession, name: str):
+    """Wait for the advisory lock `name`, held until the transaction ends."""
+    await session.execute(select(func.pg_advisory_xact_lock(func.hashtext(name))))
+
+
+async def try_lock_xact(session: AsyncSession, name: str) -> bool:
+    """Take the advisory lock `name` until the transaction ends, if it is free."""
+    return await session.scalar(
+        select(func.pg_try_advisory_xact_lock(func.hashtext(name)))
+    )
+
+
+class AdvisoryLock:
+    """Session advisory lock held on a connection of its own, across ticks.
+
+    Only one process holds it at a time, so background jobs that must not run
+    in every worker elect their runner with it. The lock goes away with the
+    connection, another worker takes over when the holder dies. A `shared`
+    lock is held by any number of processes at once, it only keeps the
+    exclusive lock of the same name away.
+    """
+
+    def __init__(self, name: str, shared: bool = False):
+        self.name = name
+        self.shared = shared
+        self._connection: AsyncConnection | None = None
+
+    async def acquire(self, wait: bool = False) -> bool:
+        """Whether this process holds the lock, taking it when it is free.
 
+        With `wait`, waits for the lock to be free instead.
+        """
+        if self._connection is not None:
+            try:
+                await self._connection.scalar(select(1))
+                return True
+            except Exception:
+                await self._connection.invalidate()
+                self._connection = None
+        connection = await async_engine.connect()
+        try:
+            connection = await connection.execution_options(
+                isolation_level="AUTOCOMMIT"
+            )
+            lock = {
+                (False, False): func.pg_try_advisory_lock,
+                (False, True): func.pg_advisory_lock,
+                (True, False): func.pg_try_advisory_lock_shared,
+                (True, True): func.pg_advisory_lock_shared,
+            }[self.shared, wait]
+            # The waiting functions return void, they only return once held.
+            held = await connection.scalar(select(lock(func.hashtext(self.name))))
+            held = held or wait
+        except BaseException:
+            await connection.close()
+            raise
+        if not held:
+            await connection.close()
+            return False
+        self._connection = connection
+        return True
 
-Session = sessionmaker(bind=engine)
+    async def release(self):
+        if self._connection is None:
+            return
+        connection, self._connection = self._connection, None
+        try:
+            unlock = (
+                func.pg_advisory_unlock_shared
+                if self.shared
+                else func.pg_advisory_unlock
+            )
+            await connection.scalar(select(unlock(func.hashtext(self.name))))
+        except Exception:
+            # Dropping the connection releases the lock as well.
+            await connection.invalidate()
+        await connection.close()
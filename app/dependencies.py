@@ -1,14 +1,19 @@
-from typing import Annotated
+from typing import Annotated, AsyncIterator, cast
 
 from fastapi import Depends, Header, HTTPException, status
 from jose import JWTError, jwt
-from passlib.context import CryptContext
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from .config import settings
-from .db import Session
+from .db import AsyncSessionLocal
 from .schemas import User
+from .user_cache import UserSnapshot, user_cache
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+async def get_session() -> AsyncIterator[AsyncSession]:
+    async with AsyncSessionLocal() as session:
+        yield session
 
 
 async def get_authorization(authorization: Annotated[str | None, Header()] = None):
@@ -30,7 +35,10 @@ async def get_token(authorization: str = Depends(get_authorization)):
     return token
 
 
-async def get_current_user(token: str = Depends(get_token)):
+async def get_current_user(
+    token: str = Depends(get_token),
+    session: AsyncSession = Depends(get_session),
+) -> UserSnapshot:
     token_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Invalid access token",
@@ -40,10 +48,32 @@ async def get_current_user(token: str = Depends(get_token)):
         user_email: str | None = payload.get("sub")
         if user_email is None:
             raise token_exception
-        with Session() as session:
-            user: User | None = session.query(User).filter_by(email=user_email).first()
-            if user is None:
-                raise token_exception
-            return user
+        cached = user_cache.get(user_email)
+        if cached is not None:
+            return cached
+        generation = user_cache.generation
+        user: User | None = await session.scalar(
+            select(User).filter_by(email=user_email)
+        )
+        if user is None:
+            raise token_exception
+        snapshot = UserSnapshot(
+            id=cast(int, user.id),
+            name=cast(str, user.name),
+            email=cast(str, user.email),
+        )
+        user_cache.put(user_email, snapshot, generation)
+        return snapshot
     except JWTError:
         raise token_exception
+
+
+async def get_admin_user(
+    current_user: UserSnapshot = Depends(get_current_user),
+) -> UserSnapshot:
+    if current_user.email not in settings.admin_emails:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Administrator access required",
+        )
+    return current_user
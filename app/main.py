@@ -5,8 +5,17 @@ from fastapi.middleware.cors import CORSMiddleware
 from prometheus_fastapi_instrumentator import Instrumentator
 from app.routers import votes
 
-from .db import init_db
-from .routers import auth, options, polls, users
+from .config import settings
+from .counters import fold_vote_slots, vote_counter_buffer
+from .db import async_engine, init_db
+from .passwords import password_hasher
+from .reconciler import vote_reconciler
+from .rollups import vote_rollup_aggregator
+from .routers import admin, auth, options, polls, users
+from .slow_queries import slow_query_log
+from .sql_stats import SQLStatsMiddleware, instrument_engine
+from .versions import poll_version_bumper
+from .ws import ws_manager
 
 description = """
 Voting App API documentation
@@ -24,6 +33,8 @@ You can authorize requests with your JSON Web Token (JWT) in the `Authorization`
 
 ## Polls
 - Create/Read/Update/Delete polls
+- List your polls page by page with `limit`, the next page is linked from the `Link` header and its cursor sent in `X-Next-Cursor`
+- Import many polls at once by posting one JSON poll per line to `/polls/import`
 
 ## Options
 - Create/Read/Update/Delete options of a poll
@@ -31,6 +42,7 @@ You can authorize requests with your JSON Web Token (JWT) in the `Authorization`
 ## Votes
 - Vote for an option or withdraw your vote
 - See real-time vote counts for each poll via WebSockets at the `/polls/<poll_id>` endpoint
+- Connect with `?mode=deltas` to receive one `{option_id: votes_count}` frame per tick instead of one frame per vote
 """
 
 tags_metadata = [
@@ -54,13 +66,41 @@ tags_metadata = [
         "name": "votes",
         "description": "Voting and vote withdrawal endpoints",
     },
+    {
+        "name": "admin",
+        "description": "Diagnostics for the accounts listed in `ADMIN_EMAILS`",
+    },
 ]
 
 
 @asynccontextmanager
 async def lifespan(_: FastAPI):
-    init_db()
+    await init_db()
+    if settings.vote_counter_mode != "striped":
+        await fold_vote_slots()
+    if settings.vote_counter_mode == "buffered":
+        await vote_counter_buffer.start()
+    # Buffered counters lag behind votes on purpose, they are only recounted
+    # when a worker starts alone.
+    reconciling = (
+        settings.vote_reconcile_enabled and settings.vote_counter_mode != "buffered"
+    )
+    if reconciling:
+        await vote_reconciler.start()
+    await poll_version_bumper.start()
+    await vote_rollup_aggregator.start()
+    await ws_manager.start()
+    if settings.slow_query_log_enabled:
+        await slow_query_log.start()
     yield
+    await slow_query_log.stop()
+    await ws_manager.stop()
+    await vote_reconciler.stop()
+    await vote_counter_buffer.stop()
+    await poll_version_bumper.stop()
+    await vote_rollup_aggregator.stop()
+    password_hasher.shutdown()
+    await async_engine.dispose()
 
 
 app = FastAPI(
@@ -72,12 +112,17 @@ app = FastAPI(
     lifespan=lifespan,
 )
 
+instrument_engine(async_engine)
+if settings.slow_query_log_enabled:
+    slow_query_log.install(async_engine)
+app.add_middleware(SQLStatsMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "Link", "X-Next-Cursor"],
 )
 
 app.include_router(auth.router)
@@ -85,5 +130,6 @@ app.include_router(users.router)
 app.include_router(polls.router)
 app.include_router(options.router)
 app.include_router(votes.router)
+app.include_router(admin.router)
 
 Instrumentator().instrument(app).expose(app)
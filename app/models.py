@@ -1,3 +1,6 @@
+from datetime import datetime
+from typing import Literal
+
 from pydantic import BaseModel, EmailStr
 
 
@@ -48,6 +51,11 @@ class PollResponse(BaseModel):
     options: list[OptionResponse]
 
 
+class PollImportResponse(BaseModel):
+    polls: int
+    options: int
+
+
 class VoteResponse(BaseModel):
     id: int
     user_id: int
@@ -55,6 +63,26 @@ class VoteResponse(BaseModel):
     option_id: int
 
 
+class VoteBatchItem(BaseModel):
+    poll_id: int
+    option_id: int
+
+
+class VoteBatchInput(BaseModel):
+    votes: list[VoteBatchItem]
+
+
+class VoteBatchResult(BaseModel):
+    poll_id: int
+    option_id: int
+    status: Literal["created", "poll_not_found", "option_not_found", "already_voted"]
+    vote_id: int | None = None
+
+
+class VoteBatchResponse(BaseModel):
+    results: list[VoteBatchResult]
+
+
 class OptionCreateInput(BaseModel):
     title: str
     description: str
@@ -74,3 +102,24 @@ class OptionUpdateInput(BaseModel):
 class PollUpdateInput(BaseModel):
     title: str | None
     description: str | None
+
+
+class TimelinePoint(BaseModel):
+    bucket: datetime
+    option_id: int
+    votes_count: int
+
+
+class TimelineResponse(BaseModel):
+    poll_id: int
+    granularity: Literal["minute", "hour", "day"]
+    points: list[TimelinePoint]
+
+
+class SlowQueryResponse(BaseModel):
+    statement: str
+    parameters: str
+    duration_ms: float
+    recorded_at: datetime
+    plan: str | None
+    analyzed: bool
@@ -0,0 +1,115 @@
+import asyncio
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable
+
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+from prometheus_client import Histogram
+
+from .config import settings
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+password_hashing_wait = Histogram(
+    "password_hashing_wait_seconds",
+    "Time spent waiting for a free password hashing worker",
+)
+password_hashing_duration = Histogram(
+    "password_hashing_duration_seconds",
+    "Time spent hashing or verifying a password",
+    ["operation"],
+    buckets=(0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 2.5, 5.0),
+)
+
+
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _verify(password: str, hashed_password: str) -> bool:
+    return pwd_context.verify(password, hashed_password)
+
+
+class PasswordHasher:
+    """Runs bcrypt off the event loop on a bounded pool of workers.
+
+    At most `workers` passwords are hashed at once and at most `max_waiting`
+    requests queue for a worker, each for no longer than `queue_timeout_ms`.
+    Anything beyond that is rejected with a 503 instead of piling up.
+    """
+
+    def __init__(
+        self, executor: str, workers: int, max_waiting: int, queue_timeout_ms: int
+    ):
+        self.executor_kind = executor
+        self.workers = workers
+        self.max_waiting = max_waiting
+        self.queue_timeout = queue_timeout_ms / 1000
+        self.waiting = 0
+        self._executor: Executor | None = None
+        self._slots: asyncio.Semaphore | None = None
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            if self.executor_kind == "process":
+                self._executor = ProcessPoolExecutor(self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(
+                    self.workers, thread_name_prefix="password-hashing"
+                )
+        return self._executor
+
+    @property
+    def slots(self) -> asyncio.Semaphore:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+        return self._slots
+
+    async def hash(self, password: str) -> str:
+        return await self._run("hash", _hash, password)
+
+    async def verify(self, password: str, hashed_password: str) -> bool:
+        return await self._run("verify", _verify, password, hashed_password)
+
+    async def _run(self, operation: str, function: Callable, *args):
+        overloaded_exception = HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many concurrent authentication requests",
+            headers={"Retry-After": "1"},
+        )
+        if self.waiting >= self.max_waiting:
+            raise overloaded_exception
+        self.waiting += 1
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(self.slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise overloaded_exception
+        finally:
+            self.waiting -= 1
+            password_hashing_wait.observe(time.perf_counter() - started)
+        started = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, function, *args)
+        finally:
+            self.slots.release()
+            password_hashing_duration.labels(operation).observe(
+                time.perf_counter() - started
+            )
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        self._slots = None
+
+
+password_hasher = PasswordHasher(
+    settings.password_hashing_executor,
+    settings.password_hashing_workers,
+    settings.password_hashing_max_waiting,
+    settings.password_hashing_queue_timeout_ms,
+)
@@ -0,0 +1,250 @@
+import sys
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from typing import Iterable, Sequence, cast
+
+from prometheus_client import Counter, Gauge
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+
+from .config import settings
+from .counters import votes_counts
+from .schemas import Option, Poll
+
+poll_cache_hits = Counter("poll_cache_hits", "Poll reads served from the cache")
+poll_cache_misses = Counter("poll_cache_misses", "Poll reads that went to the database")
+poll_cache_evictions = Counter(
+    "poll_cache_evictions", "Polls evicted from the cache to stay within its bounds"
+)
+poll_cache_entries = Gauge("poll_cache_entries", "Polls held in the cache")
+poll_cache_bytes = Gauge(
+    "poll_cache_bytes", "Estimated memory held by the cached poll snapshots"
+)
+poll_cache_hit_ratio = Gauge(
+    "poll_cache_hit_ratio", "Share of poll reads served from the cache"
+)
+
+
+@dataclass(frozen=True, slots=True)
+class OptionSnapshot:
+    id: int
+    title: str
+    description: str
+    votes_count: int
+
+
+@dataclass(frozen=True, slots=True)
+class PollSnapshot:
+    id: int
+    title: str
+    description: str
+    user_id: int
+    version: int
+    options: tuple[OptionSnapshot, ...]
+
+    def option(self, option_id: int) -> OptionSnapshot | None:
+        for option in self.options:
+            if option.id == option_id:
+                return option
+        return None
+
+
+def _footprint(snapshot: PollSnapshot) -> int:
+    size = sys.getsizeof(snapshot) + sys.getsizeof(snapshot.options)
+    size += sys.getsizeof(snapshot.title) + sys.getsizeof(snapshot.description)
+    for option in snapshot.options:
+        size += sys.getsizeof(option) + sys.getsizeof(option.votes_count)
+        size += sys.getsizeof(option.title) + sys.getsizeof(option.description)
+    return size
+
+
+class PollCache:
+    """Read-through LRU cache of poll snapshots bounded by count and memory.
+
+    Every write to a poll advances its generation. Changes to the poll or
+    its options drop the cached snapshot, votes only patch the committed
+    count of their option into it. A fill remembers the generation it
+    started from and is discarded when a write landed in between, so a slow
+    read cannot put back a stale snapshot. Polls whose version was bumped
+    off the write path are read again, see `reload_polls`.
+
+    Like the user cache it only sees the writes of the current process, the
+    TTL bounds how long other workers keep serving a changed poll.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl_seconds
+        self.entries: OrderedDict[int, tuple[float, int, PollSnapshot]] = OrderedDict()
+        self.bytes = 0
+        # Generations come from one clock, kept in write order so the oldest
+        # can be pruned. A pruned poll reports the highest pruned generation,
+        # which still invalidates any fill that started before its last write.
+        self.clock = 0
+        self.generations: OrderedDict[int, int] = OrderedDict()
+        self.floor = 0
+        self.hits = 0
+        self.misses = 0
+        poll_cache_entries.set_function(lambda: len(self.entries))
+        poll_cache_bytes.set_function(lambda: self.bytes)
+        poll_cache_hit_ratio.set_function(self.hit_ratio)
+
+    def hit_ratio(self) -> float:
+        reads = self.hits + self.misses
+        return self.hits / reads if reads else 0.0
+
+    def generation(self, poll_id: int) -> int:
+        return self.generations.get(poll_id, self.floor)
+
+    def peek(self, poll_id: int) -> PollSnapshot | None:
+        """Like `get` but neither counted in the metrics nor touching the LRU."""
+        entry = self.entries.get(poll_id)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return entry[2]
+
+    def get(self, poll_id: int) -> PollSnapshot | None:
+        entry = self.entries.get(poll_id)
+        if entry is None or entry[0] <= time.monotonic():
+            self.misses += 1
+            poll_cache_misses.inc()
+            return None
+        self.entries.move_to_end(poll_id)
+        self.hits += 1
+        poll_cache_hits.inc()
+        return entry[2]
+
+    def put(self, snapshot: PollSnapshot, generation: int):
+        if generation != self.generation(snapshot.id) or self.max_entries == 0:
+            return
+        self._store(snapshot, time.monotonic() + self.ttl)
+
+    def patch_count(self, poll_id: int, option_id: int, votes_count: int):
+        """Write the committed count of an option into the cached snapshot.
+
+        The snapshot keeps its version, which may label newer counts but
+        never older ones, the version bumper catches it up.
+        """
+        self._advance(poll_id)
+        entry = self.entries.get(poll_id)
+        if entry is None:
+            return
+        expires, _, snapshot = entry
+        if snapshot.option(option_id) is None:
+            # An option this snapshot predates.
+            self.invalidate(poll_id)
+            return
+        options = tuple(
+            replace(option, votes_count=votes_count)
+            if option.id == option_id
+            else option
+            for option in snapshot.options
+        )
+        self._store(replace(snapshot, options=options), expires)
+
+    def invalidate(self, poll_id: int):
+        self._advance(poll_id)
+        entry = self.entries.pop(poll_id, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def clear(self):
+        """Drop every poll, for writes that touch polls we cannot name."""
+        self.clock += 1
+        self.floor = self.clock
+        self.generations.clear()
+        self.entries.clear()
+        self.bytes = 0
+
+    def _store(self, snapshot: PollSnapshot, expires: float):
+        previous = self.entries.get(snapshot.id)
+        if previous is not None:
+            self.bytes -= previous[1]
+        size = _footprint(snapshot)
+        self.entries[snapshot.id] = (expires, size, snapshot)
+        self.entries.move_to_end(snapshot.id)
+        self.bytes += size
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            _, (_, size, _) = self.entries.popitem(last=False)
+            self.bytes -= size
+            poll_cache_evictions.inc()
+
+    def _advance(self, poll_id: int):
+        self.clock += 1
+        self.generations[poll_id] = self.clock
+        self.generations.move_to_end(poll_id)
+        while len(self.generations) > 2 * self.max_entries:
+            _, self.floor = self.generations.popitem(last=False)
+
+
+poll_cache = PollCache(
+    settings.poll_cache_size,
+    settings.poll_cache_max_bytes,
+    settings.poll_cache_ttl_seconds,
+)
+
+
+def _snapshot(
+    poll: Poll, options: Sequence[Option], counts: dict[int, int]
+) -> PollSnapshot:
+    return PollSnapshot(
+        id=cast(int, poll.id),
+        title=cast(str, poll.title),
+        description=cast(str, poll.description),
+        user_id=cast(int, poll.user_id),
+        version=cast(int, poll.version),
+        options=tuple(
+            OptionSnapshot(
+                id=cast(int, option.id),
+                title=cast(str, option.title),
+                description=cast(str, option.description),
+                votes_count=counts[cast(int, option.id)],
+            )
+            for option in options
+        ),
+    )
+
+
+async def load_poll(session: AsyncSession, poll_id: int) -> PollSnapshot | None:
+    """Read a poll and its options through the cache, None when it is missing."""
+    snapshot = poll_cache.get(poll_id)
+    if snapshot is not None:
+        return snapshot
+    generation = poll_cache.generation(poll_id)
+    poll: Poll | None = await session.scalar(select(Poll).filter_by(id=poll_id))
+    if not poll:
+        return None
+    options = (await session.scalars(select(Option).filter_by(poll_id=poll_id))).all()
+    # Counted after the version was read, so they are never older than it.
+    counts = await votes_counts(session, options, fresh=True)
+    snapshot = _snapshot(poll, options, counts)
+    poll_cache.put(snapshot, generation)
+    return snapshot
+
+
+async def reload_polls(session: AsyncSession, poll_ids: Iterable[int]):
+    """Read the cached polls among `poll_ids` again once their versions moved."""
+    generations = {
+        poll_id: poll_cache.generation(poll_id)
+        for poll_id in poll_ids
+        if poll_cache.peek(poll_id) is not None
+    }
+    if not generations:
+        return
+    polls = (
+        await session.scalars(
+            select(Poll)
+            .where(Poll.id.in_(generations))
+            .options(selectinload(Poll.options))
+        )
+    ).all()
+    counts = await votes_counts(
+        session, [option for poll in polls for option in poll.options], fresh=True
+    )
+    for poll in polls:
+        poll_cache.put(
+            _snapshot(poll, poll.options, counts), generations[cast(int, poll.id)]
+        )
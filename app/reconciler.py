@@ -0,0 +1,213 @@
+import asyncio
+import logging
+import time
+
+from prometheus_client import Counter, Gauge
+from sqlalchemy import func, select, update
+
+from .config import settings
+from .counters import striped_counters
+from .db import AdvisoryLock, AsyncSessionLocal
+from .poll_cache import poll_cache
+from .schemas import Option, OptionVoteSlot, Poll, Vote
+
+logger = logging.getLogger(__name__)
+
+reconciled_options = Counter(
+    "votes_count_reconciled_options", "Options whose vote counter was re-verified"
+)
+drift_corrections = Counter(
+    "votes_count_drift_corrections", "Options whose vote counter had drifted"
+)
+drift_votes = Counter(
+    "votes_count_drift_votes", "Votes added or removed by counter corrections"
+)
+reconcile_backlog = Gauge(
+    "votes_count_reconcile_backlog", "Touched options waiting to be re-verified"
+)
+
+
+def corrections(option_ids: list[int]):
+    """Statement setting the drifted counters of the options to their votes.
+
+    Returns the id, poll id, stored and expected count of the corrected options.
+    """
+    counted = (
+        select(func.count(Vote.id))
+        .where(Vote.option_id == Option.id)
+        .scalar_subquery()
+    )
+    if settings.vote_counter_mode == "striped":
+        # The option row only holds the base the slots are added to.
+        counted = counted - (
+            select(func.coalesce(func.sum(OptionVoteSlot.votes_count), 0))
+            .where(OptionVoteSlot.option_id == Option.id)
+            .scalar_subquery()
+        )
+    checked = (
+        select(
+            Option.id,
+            Option.votes_count.label("stored"),
+            counted.label("expected"),
+        )
+        .where(Option.id.in_(option_ids))
+        .cte("checked")
+    )
+    return (
+        update(Option)
+        .where(Option.id == checked.c.id, checked.c.stored != checked.c.expected)
+        .values(votes_count=checked.c.expected)
+        .returning(Option.id, Option.poll_id, checked.c.stored, checked.c.expected)
+    )
+
+
+class VoteReconciler:
+    """Re-counts the votes of recently touched options and repairs drift.
+
+    Options are picked up from two places. A watermark on `votes.id` picks
+    up the options of new votes, whichever worker cast them. Only one worker
+    runs that scan, elected with an advisory lock, and a worker taking over
+    starts from the newest vote. A withdrawn vote leaves no row to scan, so
+    the vote path touches its option in the worker that deleted it.
+    Touched options are then verified in chunks of `chunk_size` per
+    `interval_ms`, so the reconciler never costs more than one chunk at a
+    time however busy the polls are, and an option verified less than
+    `recheck_ms` ago waits in the backlog, so a hot option is re-counted
+    once per `recheck_ms` rather than on every tick.
+
+    Each chunk locks its option rows first, so a vote is either counted by
+    the re-count or applies its increment after the correction. The lock
+    is FOR NO KEY UPDATE, which lets votes insert rows referencing the
+    options while they are counted.
+    """
+
+    def __init__(
+        self, interval_ms: int, chunk_size: int, scan_size: int, recheck_ms: int
+    ):
+        self.interval = interval_ms / 1000
+        self.chunk_size = chunk_size
+        self.scan_size = scan_size
+        self.recheck = recheck_ms / 1000
+        self.pending: set[int] = set()
+        # Last verification of each option, oldest first.
+        self.verified: dict[int, float] = {}
+        self.watermark: int | None = None
+        self.runner = AdvisoryLock("vote_reconciler.runner")
+        self._task: asyncio.Task | None = None
+        reconcile_backlog.set_function(lambda: len(self.pending))
+
+    def touch(self, option_id: int):
+        if self._task is not None:
+            self.pending.add(option_id)
+
+    async def start(self):
+        if await self.runner.acquire():
+            await self.scan()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self.watermark = None
+        await self.runner.release()
+
+    async def scan(self):
+        """Touch the options of the votes recorded since the watermark."""
+        async with AsyncSessionLocal() as session:
+            if self.watermark is None:
+                self.watermark = await session.scalar(select(func.max(Vote.id))) or 0
+                return
+            votes = (
+                await session.execute(
+                    select(Vote.id, Vote.option_id)
+                    .where(Vote.id > self.watermark)
+                    .order_by(Vote.id)
+                    .limit(self.scan_size)
+                )
+            ).all()
+        for vote_id, option_id in votes:
+            self.pending.add(option_id)
+            self.watermark = vote_id
+
+    async def reconcile(self, option_ids: list[int]) -> int:
+        """Repair the counters of the given options, returns how many drifted."""
+        async with AsyncSessionLocal() as session:
+            await session.execute(
+                select(Option.id)
+                .where(Option.id.in_(option_ids))
+                .order_by(Option.id)
+                .with_for_update(key_share=True)
+            )
+            corrected = (await session.execute(corrections(option_ids))).all()
+            poll_ids = {poll_id for _, poll_id, _, _ in corrected}
+            if poll_ids:
+                await session.execute(
+                    update(Poll)
+                    .where(Poll.id.in_(poll_ids))
+                    .values(version=Poll.version + 1)
+                )
+            await session.commit()
+        reconciled_options.inc(len(option_ids))
+        for option_id, _, stored, expected in corrected:
+            logger.warning(
+                "Corrected votes_count of option %s from %s to %s",
+                option_id,
+                stored,
+                expected,
+            )
+            drift_corrections.inc()
+            drift_votes.inc(abs(expected - stored))
+            striped_counters.forget(option_id)
+        for poll_id in poll_ids:
+            poll_cache.invalidate(poll_id)
+        return len(corrected)
+
+    async def step(self):
+        if await self.runner.acquire():
+            await self.scan()
+        else:
+            self.watermark = None
+        now = time.monotonic()
+        while self.verified:
+            option_id, verified = next(iter(self.verified.items()))
+            if verified > now - self.recheck:
+                break
+            del self.verified[option_id]
+        chunk = []
+        for option_id in self.pending:
+            if len(chunk) == self.chunk_size:
+                break
+            if option_id not in self.verified:
+                chunk.append(option_id)
+        if not chunk:
+            return
+        self.pending.difference_update(chunk)
+        try:
+            await self.reconcile(chunk)
+        except Exception:
+            self.pending.update(chunk)
+            raise
+        for option_id in chunk:
+            self.verified[option_id] = now
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.step()
+            except Exception:
+                logger.exception("Failed to reconcile vote counters, retrying later")
+
+
+vote_reconciler = VoteReconciler(
+    settings.vote_reconcile_interval_ms,
+    settings.vote_reconcile_chunk_size,
+    settings.vote_reconcile_scan_size,
+    settings.vote_reconcile_recheck_ms,
+)
@@ -0,0 +1,176 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+from prometheus_client import Gauge
+from sqlalchemy import (DateTime, Integer, cast, column, delete, exists, func,
+                        select, values)
+from sqlalchemy.dialects.postgresql import insert
+
+from .config import settings
+from .db import AdvisoryLock, AsyncSessionLocal, lock_xact
+from .schemas import Vote, VoteRollup
+
+logger = logging.getLogger(__name__)
+
+rollup_backlog = Gauge(
+    "vote_rollup_backlog", "Withdrawn votes whose bucket waits to be re-counted"
+)
+
+
+def recount_rollups(votes_filter, rollups_filter):
+    """Statement re-counting the rollups of the votes matching `votes_filter`.
+
+    `rollups_filter` must match the same buckets, the ones left without
+    votes are deleted.
+    """
+    bucket = func.date_trunc("minute", Vote.created_at)
+    counted = (
+        select(
+            Vote.poll_id,
+            Vote.option_id,
+            bucket.label("bucket"),
+            func.count().label("votes_count"),
+        )
+        .where(votes_filter)
+        .group_by(Vote.poll_id, Vote.option_id, bucket)
+        .cte("counted")
+    )
+    upsert = insert(VoteRollup).from_select(
+        ["poll_id", "option_id", "bucket", "votes_count"], select(counted)
+    )
+    upserted = upsert.on_conflict_do_update(
+        index_elements=["poll_id", "option_id", "bucket"],
+        set_={"votes_count": upsert.excluded.votes_count},
+        where=VoteRollup.votes_count != upsert.excluded.votes_count,
+    ).cte("upserted")
+    return (
+        delete(VoteRollup)
+        .where(
+            rollups_filter,
+            ~exists().where(
+                counted.c.poll_id == VoteRollup.poll_id,
+                counted.c.option_id == VoteRollup.option_id,
+                counted.c.bucket == VoteRollup.bucket,
+            ),
+        )
+        .add_cte(upserted)
+    )
+
+
+class VoteRollupAggregator:
+    """Keeps the per-minute vote rollups in line with the votes, off the vote path.
+
+    Every `interval_ms` the elected worker re-counts the buckets of the last
+    `lag_seconds` from `votes.created_at`, which covers the votes of every
+    worker and the transactions that committed late. Its first pass starts
+    from the newest rollup, to catch up on the votes of a runner that died.
+    Votes withdrawn from older buckets are only known to the worker that
+    deleted them, so each worker re-counts those buckets itself.
+
+    Passes re-count rather than add deltas and take turns on a lock, so the
+    last pass to write a bucket is also the one that counted it last.
+    """
+
+    def __init__(self, interval_ms: int, lag_seconds: int):
+        self.interval = interval_ms / 1000
+        self.lag = timedelta(seconds=lag_seconds)
+        self.pending: set[tuple[int, datetime]] = set()
+        self.runner = AdvisoryLock("vote_rollups.runner")
+        self.caught_up = False
+        self._task: asyncio.Task | None = None
+        rollup_backlog.set_function(lambda: len(self.pending))
+
+    def touch(self, poll_id: int, created_at: datetime):
+        """Record a withdrawn vote, cast at `created_at`."""
+        if self._task is not None:
+            self.pending.add((poll_id, created_at))
+
+    def recent(self):
+        since = func.date_trunc("minute", func.now() - self.lag)
+        if not self.caught_up:
+            newest = select(func.max(VoteRollup.bucket)).scalar_subquery()
+            since = func.least(since, newest - self.lag)
+        return recount_rollups(Vote.created_at >= since, VoteRollup.bucket >= since)
+
+    def withdrawn(self, votes: set[tuple[int, datetime]]):
+        buckets = (
+            select(
+                column("poll_id", Integer),
+                func.date_trunc(
+                    "minute", cast(column("created_at"), DateTime(timezone=True))
+                ).label("bucket"),
+            )
+            .select_from(
+                values(
+                    column("poll_id", Integer),
+                    column("created_at", DateTime(timezone=True)),
+                    name="withdrawn_votes",
+                ).data(list(votes))
+            )
+            .distinct()
+            .cte("buckets")
+        )
+        poll_ids = {poll_id for poll_id, _ in votes}
+        return recount_rollups(
+            Vote.poll_id.in_(poll_ids)
+            & exists().where(
+                buckets.c.poll_id == Vote.poll_id,
+                buckets.c.bucket == func.date_trunc("minute", Vote.created_at),
+            ),
+            VoteRollup.poll_id.in_(poll_ids)
+            & exists().where(
+                buckets.c.poll_id == VoteRollup.poll_id,
+                buckets.c.bucket == VoteRollup.bucket,
+            ),
+        )
+
+    async def flush(self):
+        running = await self.runner.acquire()
+        if not running:
+            self.caught_up = False
+        if not running and not self.pending:
+            return
+        votes, self.pending = self.pending, set()
+        try:
+            async with AsyncSessionLocal() as session:
+                await lock_xact(session, "vote_rollups")
+                if votes:
+                    await session.execute(self.withdrawn(votes))
+                if running:
+                    await session.execute(self.recent())
+                await session.commit()
+        except BaseException:
+            self.pending.update(votes)
+            raise
+        self.caught_up = self.caught_up or running
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        try:
+            await self.flush()
+        finally:
+            await self.runner.release()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to update the vote rollups, retrying later")
+
+
+vote_rollup_aggregator = VoteRollupAggregator(
+    settings.vote_rollup_interval_ms, settings.vote_rollup_lag_seconds
+)
@@ -0,0 +1,32 @@
+from fastapi import APIRouter, Depends, status
+
+from app.dependencies import get_admin_user
+from app.models import SlowQueryResponse
+from app.slow_queries import slow_query_log
+from app.user_cache import UserSnapshot
+
+router = APIRouter()
+
+
+@router.get(
+    "/admin/slow-queries",
+    response_model=list[SlowQueryResponse],
+    status_code=status.HTTP_200_OK,
+    summary="Get recent slow queries",
+    tags=["admin"],
+)
+async def get_slow_queries(_: UserSnapshot = Depends(get_admin_user)):
+    slow_queries: list[SlowQueryResponse] = []
+    for entry in reversed(slow_query_log.entries):
+        plan = slow_query_log.plans.get(entry.statement)
+        slow_queries.append(
+            SlowQueryResponse(
+                statement=entry.statement,
+                parameters=entry.parameters,
+                duration_ms=entry.duration * 1000,
+                recorded_at=entry.recorded_at,
+                plan=plan.plan if plan else None,
+                analyzed=plan.analyzed if plan else False,
+            )
+        )
+    return slow_queries
@@ -1,13 +1,15 @@
 from datetime import datetime, timedelta
 from typing import cast
 
-from fastapi import APIRouter, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, status
 from jose import jwt
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.config import settings
-from app.db import Session
-from app.dependencies import pwd_context
+from app.dependencies import get_session
 from app.models import Credentials, LoginResponse, NewUser
+from app.passwords import password_hasher
 from app.schemas import User
 
 router = APIRouter()
@@ -20,18 +22,17 @@ router = APIRouter()
     summary="Register new user",
     tags=["auth"],
 )
-async def register(new_user: NewUser):
-    with Session() as session:
-        hashed_password = pwd_context.hash(new_user.password)
-        user = User(
-            name=new_user.name, email=new_user.email, hashed_password=hashed_password
-        )
-        session.add(user)
-        session.commit()
-        access_token = create_access_token(
-            data={"sub": user.email}, expires_delta=timedelta(days=1)
-        )
-        return LoginResponse(access_token=access_token)
+async def register(new_user: NewUser, session: AsyncSession = Depends(get_session)):
+    hashed_password = await password_hasher.hash(new_user.password)
+    user = User(
+        name=new_user.name, email=new_user.email, hashed_password=hashed_password
+    )
+    session.add(user)
+    await session.commit()
+    access_token = create_access_token(
+        data={"sub": user.email}, expires_delta=timedelta(days=1)
+    )
+    return LoginResponse(access_token=access_token)
 
 
 def create_access_token(data: dict, expires_delta: timedelta):
@@ -49,21 +50,22 @@ def create_access_token(data: dict, expires_delta: timedelta):
     summary="Login user",
     tags=["auth"],
 )
-async def authenticate_user(credentials: Credentials):
-    with Session() as session:
-        credentials_exception = HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Incorrect credentials",
-        )
-        user: User | None = (
-            session.query(User).filter_by(email=credentials.email).first()
-        )
-        if not user:
-            raise credentials_exception
-        hashed_password = cast(str, user.hashed_password)
-        if not pwd_context.verify(credentials.password, hashed_password):
-            raise credentials_exception
-        access_token = create_access_token(
-            data={"sub": user.email}, expires_delta=timedelta(days=1)
-        )
-        return LoginResponse(access_token=access_token)
+async def authenticate_user(
+    credentials: Credentials, session: AsyncSession = Depends(get_session)
+):
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Incorrect credentials",
+    )
+    user: User | None = await session.scalar(
+        select(User).filter_by(email=credentials.email)
+    )
+    if not user:
+        raise credentials_exception
+    hashed_password = cast(str, user.hashed_password)
+    if not await password_hasher.verify(credentials.password, hashed_password):
+        raise credentials_exception
+    access_token = create_access_token(
+        data={"sub": user.email}, expires_delta=timedelta(days=1)
+    )
+    return LoginResponse(access_token=access_token)
@@ -1,11 +1,17 @@
 from typing import cast
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import (APIRouter, Depends, HTTPException, Request, Response,
+                     status)
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.db import Session
-from app.dependencies import get_current_user
+from app.counters import votes_counts
+from app.dependencies import get_current_user, get_session
 from app.models import OptionCreateInput, OptionResponse, OptionUpdateInput
-from app.schemas import Option, Poll, User
+from app.poll_cache import load_poll, poll_cache
+from app.schemas import Option, Poll
+from app.user_cache import UserSnapshot
+from app.versions import bump_version, poll_etag, revalidate_poll
 
 router = APIRouter()
 
@@ -17,23 +23,30 @@ router = APIRouter()
     summary="Get poll options",
     tags=["options"],
 )
-async def get_options(poll_id: int):
-    with Session() as session:
-        poll: Poll | None = session.query(Poll).filter_by(id=poll_id).first()
-        if not poll:
-            raise HTTPException(status_code=404, detail="Poll not found")
-        options: list[Option] = session.query(Option).filter_by(poll_id=poll_id).all()
-        options_response: list[OptionResponse] = []
-        for option in options:
-            options_response.append(
-                OptionResponse(
-                    id=cast(int, option.id),
-                    title=cast(str, option.title),
-                    description=cast(str, option.description),
-                    votes_count=cast(int, option.votes_count),
-                )
+async def get_options(
+    poll_id: int,
+    request: Request,
+    response: Response,
+    session: AsyncSession = Depends(get_session),
+):
+    unchanged = await revalidate_poll(request, session, poll_id)
+    if unchanged is not None:
+        return unchanged
+    poll = await load_poll(session, poll_id)
+    if not poll:
+        raise HTTPException(status_code=404, detail="Poll not found")
+    response.headers["ETag"] = poll_etag(poll.version)
+    options_response: list[OptionResponse] = []
+    for option in poll.options:
+        options_response.append(
+            OptionResponse(
+                id=option.id,
+                title=option.title,
+                description=option.description,
+                votes_count=option.votes_count,
             )
-        return options_response
+        )
+    return options_response
 
 
 @router.get(
@@ -43,20 +56,30 @@ async def get_options(poll_id: int):
     summary="Get poll option",
     tags=["options"],
 )
-async def get_option(poll_id: int, option_id: int):
-    with Session() as session:
-        option: Option | None = session.query(Option).filter_by(id=option_id).first()
-        if not option:
-            raise HTTPException(status_code=404, detail="Option not found")
-        poll: Poll | None = session.query(Poll).filter_by(id=poll_id).first()
-        if not poll:
-            raise HTTPException(status_code=404, detail="Poll not found")
+async def get_option(
+    poll_id: int, option_id: int, session: AsyncSession = Depends(get_session)
+):
+    poll = await load_poll(session, poll_id)
+    cached = poll.option(option_id) if poll else None
+    if cached:
         return OptionResponse(
-            id=cast(int, option.id),
-            title=cast(str, option.title),
-            description=cast(str, option.description),
-            votes_count=cast(int, option.votes_count),
+            id=cached.id,
+            title=cached.title,
+            description=cached.description,
+            votes_count=cached.votes_count,
         )
+    option: Option | None = await session.scalar(select(Option).filter_by(id=option_id))
+    if not option:
+        raise HTTPException(status_code=404, detail="Option not found")
+    if not poll:
+        raise HTTPException(status_code=404, detail="Poll not found")
+    counts = await votes_counts(session, [option])
+    return OptionResponse(
+        id=cast(int, option.id),
+        title=cast(str, option.title),
+        description=cast(str, option.description),
+        votes_count=counts[cast(int, option.id)],
+    )
 
 
 @router.post(
@@ -69,31 +92,32 @@ async def get_option(poll_id: int, option_id: int):
 async def create_option(
     poll_id: int,
     option: OptionCreateInput,
-    current_user: User = Depends(get_current_user),
+    current_user: UserSnapshot = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session),
 ):
-    with Session() as session:
-        poll: Poll | None = session.query(Poll).filter_by(id=poll_id).first()
-        if not poll:
-            raise HTTPException(status_code=404, detail="Poll not found")
-        if poll.user_id != current_user.id:
-            raise HTTPException(
-                status_code=403, detail="You are not authorized to create an option"
-            )
-        new_option = Option(
-            title=option.title,
-            description=option.description,
-            poll_id=poll_id,
-            votes_count=0,
-        )
-        session.add(new_option)
-        session.commit()
-        session.refresh(new_option)
-        return OptionResponse(
-            id=cast(int, new_option.id),
-            title=cast(str, new_option.title),
-            description=cast(str, new_option.description),
-            votes_count=0,
+    poll: Poll | None = await session.scalar(select(Poll).filter_by(id=poll_id))
+    if not poll:
+        raise HTTPException(status_code=404, detail="Poll not found")
+    if poll.user_id != current_user.id:
+        raise HTTPException(
+            status_code=403, detail="You are not authorized to create an option"
         )
+    new_option = Option(
+        title=option.title,
+        description=option.description,
+        poll_id=poll_id,
+        votes_count=0,
+    )
+    session.add(new_option)
+    await session.execute(bump_version(poll_id))
+    await session.commit()
+    poll_cache.invalidate(poll_id)
+    return OptionResponse(
+        id=cast(int, new_option.id),
+        title=cast(str, new_option.title),
+        description=cast(str, new_option.description),
+        votes_count=0,
+    )
 
 
 @router.put(
@@ -106,30 +130,33 @@ async def update_option(
     poll_id: int,
     option_id: int,
     option_update: OptionUpdateInput,
-    current_user: User = Depends(get_current_user),
+    current_user: UserSnapshot = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session),
 ):
-    with Session() as session:
-        option: Option | None = session.query(Option).filter_by(id=option_id).first()
-        if not option:
-            raise HTTPException(status_code=404, detail="Option not found")
-        poll: Poll | None = session.query(Poll).filter_by(id=poll_id).first()
-        if not poll:
-            raise HTTPException(status_code=404, detail="Poll not found")
-        if option.poll_id != poll_id or poll.user_id != current_user.id:
-            raise HTTPException(
-                status_code=403, detail="You are not authorized to update this option"
-            )
-        if option_update.title is not None:
-            session.query(Option).filter_by(id=option_id).update(
-                {"title": option_update.title}
-            )
-        if option_update.description is not None:
-            session.query(Option).filter_by(id=option_id).update(
-                {"description": option_update.description}
-            )
-        session.commit()
-        session.refresh(option)
-        return
+    option: Option | None = await session.scalar(select(Option).filter_by(id=option_id))
+    if not option:
+        raise HTTPException(status_code=404, detail="Option not found")
+    poll: Poll | None = await session.scalar(select(Poll).filter_by(id=poll_id))
+    if not poll:
+        raise HTTPException(status_code=404, detail="Poll not found")
+    if option.poll_id != poll_id or poll.user_id != current_user.id:
+        raise HTTPException(
+            status_code=403, detail="You are not authorized to update this option"
+        )
+    if option_update.title is not None:
+        await session.execute(
+            update(Option).filter_by(id=option_id).values(title=option_update.title)
+        )
+    if option_update.description is not None:
+        await session.execute(
+            update(Option)
+            .filter_by(id=option_id)
+            .values(description=option_update.description)
+        )
+    await session.execute(bump_version(poll_id))
+    await session.commit()
+    poll_cache.invalidate(poll_id)
+    return
 
 
 @router.delete(
@@ -141,19 +168,21 @@ async def update_option(
 async def delete_option(
     poll_id: int,
     option_id: int,
-    current_user: User = Depends(get_current_user),
+    current_user: UserSnapshot = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session),
 ):
-    with Session() as session:
-        option: Option | None = session.query(Option).filter_by(id=option_id).first()
-        if not option:
-            raise HTTPException(status_code=404, detail="Option not found")
-        poll: Poll | None = session.query(Poll).filter_by(id=poll_id).first()
-        if not poll:
-            raise HTTPException(status_code=404, detail="Poll not found")
-        if option.poll_id != poll_id or poll.user_id != current_user.id:
-            raise HTTPException(
-                status_code=403, detail="You are not authorized to delete this option"
-            )
-        session.delete(option)
-        session.commit()
-        return
+    option: Option | None = await session.scalar(select(Option).filter_by(id=option_id))
+    if not option:
+        raise HTTPException(status_code=404, detail="Option not found")
+    poll: Poll | None = await session.scalar(select(Poll).filter_by(id=poll_id))
+    if not poll:
+        raise HTTPException(status_code=404, detail="Poll not found")
+    if option.poll_id != poll_id or poll.user_id != current_user.id:
+        raise HTTPException(
+            status_code=403, detail="You are not authorized to delete this option"
+        )
+    await session.delete(option)
+    await session.execute(bump_version(poll_id))
+    await session.commit()
+    poll_cache.invalidate(poll_id)
+    return
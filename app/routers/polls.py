@@ -1,18 +1,105 @@
-from typing import cast
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from typing import AsyncIterator, Sequence, cast
 
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import joinedload
+from fastapi import (APIRouter, Depends, HTTPException, Query, Request,
+                     Response, status)
+from pydantic import ValidationError
+from sqlalchemy import insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
 
-from app.db import Session
-from app.dependencies import get_current_user
-from app.models import (OptionResponse, PollCreateInput, PollResponse,
-                        PollUpdateInput)
-from app.schemas import Option, Poll, User
+from app.config import settings
+from app.counters import votes_counts
+from app.dependencies import get_current_user, get_session
+from app.models import (OptionResponse, PollCreateInput, PollImportResponse,
+                        PollResponse, PollUpdateInput)
+from app.poll_cache import load_poll, poll_cache
+from app.schemas import Option, Poll
+from app.user_cache import UserSnapshot
+from app.versions import not_modified, page_etag, poll_etag, revalidate_poll
 
 router = APIRouter()
 
 
-# TODO: add pagination
+def encode_cursor(poll_id: int) -> str:
+    return urlsafe_b64encode(str(poll_id).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        return int(urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def user_polls_query(user_id: int, after: int | None, limit: int):
+    """Keyset page of a user's polls on the (user_id, id) index.
+
+    One extra row tells whether there is a next page.
+    """
+    query = select(Poll).filter(Poll.user_id == user_id)
+    if after is not None:
+        query = query.filter(Poll.id > after)
+    return query.order_by(Poll.id).limit(limit + 1)
+
+
+async def insert_polls(
+    session: AsyncSession, user_id: int, polls: Sequence[PollCreateInput]
+) -> tuple[list[int], list[int]]:
+    """Insert polls and their options with one multi-row statement per table.
+
+    Returns the new poll ids and option ids in input order, nothing is
+    committed.
+    """
+    poll_ids = (
+        await session.scalars(
+            insert(Poll).returning(Poll.id, sort_by_parameter_order=True),
+            [
+                {
+                    "title": poll.title,
+                    "description": poll.description,
+                    "user_id": user_id,
+                }
+                for poll in polls
+            ],
+        )
+    ).all()
+    options = [
+        {
+            "title": option.title,
+            "description": option.description,
+            "poll_id": poll_id,
+            "votes_count": 0,
+        }
+        for poll_id, poll in zip(poll_ids, polls)
+        for option in poll.options
+    ]
+    if not options:
+        return list(poll_ids), []
+    option_ids = (
+        await session.scalars(
+            insert(Option).returning(Option.id, sort_by_parameter_order=True),
+            options,
+        )
+    ).all()
+    return list(poll_ids), list(option_ids)
+
+
+async def ndjson_lines(request: Request) -> AsyncIterator[tuple[int, bytes]]:
+    """Non-blank lines of a streamed request body with their line numbers."""
+    buffer = b""
+    line_number = 0
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            line_number += 1
+            if line.strip():
+                yield line_number, line
+    if buffer.strip():
+        yield line_number + 1, buffer
+
+
 @router.get(
     "/polls",
     response_model=list[PollResponse],
@@ -20,37 +107,66 @@ router = APIRouter()
     summary="Get all polls",
     tags=["polls"],
 )
-async def get_polls(current_user: User = Depends(get_current_user)):
-    with Session() as session:
-        # TODO: add proper typing
-        user_polls = (
-            session.query(Poll)
-            .filter(Poll.user_id == current_user.id)
-            .options(joinedload(Poll.options))
-            .all()
-        )
-        polls_response: list[PollResponse] = []
-        for poll in user_polls:
-            options_response: list[OptionResponse] = []
-            for option in poll.options:
-                options_response.append(
-                    OptionResponse(
-                        id=cast(int, option.id),
-                        title=cast(str, option.title),
-                        description=cast(str, option.description),
-                        votes_count=cast(int, option.votes_count),
-                    )
-                )
-            polls_response.append(
-                PollResponse(
-                    id=cast(int, poll.id),
-                    title=cast(str, poll.title),
-                    description=cast(str, poll.description),
-                    user_id=cast(int, poll.user_id),
-                    options=options_response,
+async def get_polls(
+    request: Request,
+    response: Response,
+    limit: int = Query(default=50, ge=1, le=200),
+    cursor: str | None = None,
+    current_user: UserSnapshot = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session),
+):
+    after = decode_cursor(cursor) if cursor is not None else None
+    query = user_polls_query(current_user.id, after, limit)
+    if "if-none-match" in request.headers:
+        # Revalidate from the versions alone before loading any option.
+        page = (
+            await session.execute(query.with_only_columns(Poll.id, Poll.version))
+        ).all()
+        etag = page_etag(page[:limit], len(page) > limit)
+        unchanged = not_modified(request, etag)
+        if unchanged is not None:
+            return unchanged
+    user_polls = (
+        await session.scalars(query.options(selectinload(Poll.options)))
+    ).all()
+    response.headers["ETag"] = page_etag(
+        [(cast(int, poll.id), cast(int, poll.version)) for poll in user_polls[:limit]],
+        len(user_polls) > limit,
+    )
+    next_cursor = None
+    if len(user_polls) > limit:
+        user_polls = user_polls[:limit]
+        next_cursor = encode_cursor(cast(int, user_polls[-1].id))
+    counts = await votes_counts(
+        session, [option for poll in user_polls for option in poll.options], fresh=True
+    )
+    polls_response: list[PollResponse] = []
+    for poll in user_polls:
+        options_response: list[OptionResponse] = []
+        for option in poll.options:
+            options_response.append(
+                OptionResponse(
+                    id=cast(int, option.id),
+                    title=cast(str, option.title),
+                    description=cast(str, option.description),
+                    votes_count=counts[cast(int, option.id)],
                 )
             )
-        return polls_response
+        polls_response.append(
+            PollResponse(
+                id=cast(int, poll.id),
+                title=cast(str, poll.title),
+                description=cast(str, poll.description),
+                user_id=cast(int, poll.user_id),
+                options=options_response,
+            )
+        )
+    if next_cursor is not None:
+        # The body stays a plain list, the next page is linked from the headers.
+        next_url = request.url.include_query_params(cursor=next_cursor)
+        response.headers["Link"] = f'<{next_url}>; rel="next"'
+        response.headers["X-Next-Cursor"] = next_cursor
+    return polls_response
 
 
 @router.get(
@@ -60,29 +176,36 @@ async def get_polls(current_user: User = Depends(get_current_user)):
     summary="Get poll",
     tags=["polls"],
 )
-async def get_poll(poll_id: int):
-    with Session() as session:
-        poll: Poll | None = session.query(Poll).filter_by(id=poll_id).first()
-        if not poll:
-            raise HTTPException(status_code=404, detail="Poll not found")
-        options: list[Option] = session.query(Option).filter_by(poll_id=poll_id).all()
-        options_response = []
-        for option in options:
-            options_response.append(
-                OptionResponse(
-                    id=cast(int, option.id),
-                    title=cast(str, option.title),
-                    description=cast(str, option.description),
-                    votes_count=cast(int, option.votes_count),
-                )
+async def get_poll(
+    poll_id: int,
+    request: Request,
+    response: Response,
+    session: AsyncSession = Depends(get_session),
+):
+    unchanged = await revalidate_poll(request, session, poll_id)
+    if unchanged is not None:
+        return unchanged
+    poll = await load_poll(session, poll_id)
+    if not poll:
+        raise HTTPException(status_code=404, detail="Poll not found")
+    response.headers["ETag"] = poll_etag(poll.version)
+    options_response = []
+    for option in poll.options:
+        options_response.append(
+            OptionResponse(
+                id=option.id,
+                title=option.title,
+                description=option.description,
+                votes_count=option.votes_count,
             )
-        return PollResponse(
-            id=cast(int, poll.id),
-            title=cast(str, poll.title),
-            description=cast(str, poll.description),
-            user_id=cast(int, poll.user_id),
-            options=options_response,
         )
+    return PollResponse(
+        id=poll.id,
+        title=poll.title,
+        description=poll.description,
+        user_id=poll.user_id,
+        options=options_response,
+    )
 
 
 @router.post(
@@ -93,41 +216,68 @@ async def get_poll(poll_id: int):
     tags=["polls"],
 )
 async def create_poll(
-    poll: PollCreateInput, current_user: User = Depends(get_current_user)
+    poll: PollCreateInput,
+    current_user: UserSnapshot = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session),
 ):
-    with Session() as session:
-        new_poll = Poll(
-            title=poll.title, description=poll.description, user_id=current_user.id
-        )
-        session.add(new_poll)
-        session.commit()
-        session.refresh(new_poll)
-        options_response: list[OptionResponse] = []
-        for option in poll.options:
-            new_option = Option(
+    (poll_id,), option_ids = await insert_polls(session, current_user.id, [poll])
+    await session.commit()
+    options_response: list[OptionResponse] = []
+    for option_id, option in zip(option_ids, poll.options):
+        options_response.append(
+            OptionResponse(
+                id=option_id,
                 title=option.title,
                 description=option.description,
-                poll_id=new_poll.id,
                 votes_count=0,
             )
-            session.add(new_option)
-            session.commit()
-            session.refresh(new_option)
-            options_response.append(
-                OptionResponse(
-                    id=cast(int, new_option.id),
-                    title=cast(str, new_option.title),
-                    description=cast(str, new_option.description),
-                    votes_count=0,
-                )
-            )
-        return PollResponse(
-            id=cast(int, new_poll.id),
-            title=cast(str, new_poll.title),
-            description=cast(str, new_poll.description),
-            user_id=cast(int, new_poll.user_id),
-            options=options_response,
         )
+    return PollResponse(
+        id=poll_id,
+        title=poll.title,
+        description=poll.description,
+        user_id=current_user.id,
+        options=options_response,
+    )
+
+
+@router.post(
+    "/polls/import",
+    status_code=status.HTTP_201_CREATED,
+    response_model=PollImportResponse,
+    summary="Import polls",
+    tags=["polls"],
+)
+async def import_polls(
+    request: Request,
+    current_user: UserSnapshot = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session),
+):
+    """Import polls from an NDJSON body, one poll with its options per line.
+
+    The body is streamed and inserted in batches, all in one transaction: an
+    invalid line rejects the whole import.
+    """
+    polls_count = options_count = 0
+    batch: list[PollCreateInput] = []
+    async for line_number, line in ndjson_lines(request):
+        try:
+            batch.append(PollCreateInput.model_validate_json(line))
+        except ValidationError:
+            raise HTTPException(
+                status_code=422, detail=f"Invalid poll on line {line_number}"
+            )
+        if len(batch) >= settings.poll_import_batch_size:
+            poll_ids, option_ids = await insert_polls(session, current_user.id, batch)
+            polls_count += len(poll_ids)
+            options_count += len(option_ids)
+            batch = []
+    if batch:
+        poll_ids, option_ids = await insert_polls(session, current_user.id, batch)
+        polls_count += len(poll_ids)
+        options_count += len(option_ids)
+    await session.commit()
+    return PollImportResponse(polls=polls_count, options=options_count)
 
 
 @router.put(
@@ -139,27 +289,30 @@ async def create_poll(
 async def update_poll(
     poll_id: int,
     poll_update: PollUpdateInput,
-    current_user: User = Depends(get_current_user),
+    current_user: UserSnapshot = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session),
 ):
-    with Session() as session:
-        poll: Poll | None = session.query(Poll).filter_by(id=poll_id).first()
-        if not poll:
-            raise HTTPException(status_code=404, detail="Poll not found")
-        if poll.user_id != current_user.id:
-            raise HTTPException(
-                status_code=403, detail="You are not authorized to update this poll"
-            )
-        if poll_update.title is not None:
-            session.query(Poll).filter_by(id=poll_id).update(
-                {"title": poll_update.title}
-            )
-        if poll_update.description is not None:
-            session.query(Poll).filter_by(id=poll_id).update(
-                {"description": poll_update.description}
-            )
-        session.commit()
-        session.refresh(poll)
-        return
+    poll: Poll | None = await session.scalar(select(Poll).filter_by(id=poll_id))
+    if not poll:
+        raise HTTPException(status_code=404, detail="Poll not found")
+    if poll.user_id != current_user.id:
+        raise HTTPException(
+            status_code=403, detail="You are not authorized to update this poll"
+        )
+    values = {}
+    if poll_update.title is not None:
+        values["title"] = poll_update.title
+    if poll_update.description is not None:
+        values["description"] = poll_update.description
+    if values:
+        await session.execute(
+            update(Poll)
+            .filter_by(id=poll_id)
+            .values(**values, version=Poll.version + 1)
+        )
+    await session.commit()
+    poll_cache.invalidate(poll_id)
+    return
 
 
 @router.delete(
@@ -168,15 +321,19 @@ async def update_poll(
     summary="Delete poll",
     tags=["polls"],
 )
-async def delete_poll(poll_id: int, current_user: User = Depends(get_current_user)):
-    with Session() as session:
-        poll: Poll | None = session.query(Poll).filter_by(id=poll_id).first()
-        if not poll:
-            raise HTTPException(status_code=404, detail="Poll not found")
-        if poll.user_id != current_user.id:
-            raise HTTPException(
-                status_code=403, detail="You are not authorized to delete this poll"
-            )
-        session.delete(poll)
-        session.commit()
-        return
+async def delete_poll(
+    poll_id: int,
+    current_user: UserSnapshot = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session),
+):
+    poll: Poll | None = await session.scalar(select(Poll).filter_by(id=poll_id))
+    if not poll:
+        raise HTTPException(status_code=404, detail="Poll not found")
+    if poll.user_id != current_user.id:
+        raise HTTPException(
+            status_code=403, detail="You are not authorized to delete this poll"
+        )
+    await session.delete(poll)
+    await session.commit()
+    poll_cache.invalidate(poll_id)
+    return
@@ -1,11 +1,19 @@
+from collections import Counter
 from typing import cast
 
 from fastapi import APIRouter, Depends, HTTPException, status
+from sqlalchemy import Integer, column, select, update, values
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.db import Session
-from app.dependencies import get_current_user, pwd_context
+from app.counters import striped_counters
+from app.dependencies import get_current_user, get_session
 from app.models import Profile, UserResponse, UserUpdateInput
-from app.schemas import User
+from app.passwords import password_hasher
+from app.poll_cache import poll_cache
+from app.rollups import vote_rollup_aggregator
+from app.schemas import Option, Poll, User, Vote
+from app.user_cache import UserSnapshot, user_cache
+from app.versions import bump_versions
 
 router = APIRouter()
 
@@ -17,14 +25,13 @@ router = APIRouter()
     summary="Get user profile",
     tags=["users"],
 )
-async def get_user_profile(user_id: int):
-    with Session() as session:
-        user: User | None = session.query(User).filter_by(id=user_id).first()
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
-        return Profile(
-            name=cast(str, user.name),
-        )
+async def get_user_profile(user_id: int, session: AsyncSession = Depends(get_session)):
+    user: User | None = await session.scalar(select(User).filter_by(id=user_id))
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    return Profile(
+        name=cast(str, user.name),
+    )
 
 
 @router.get(
@@ -34,7 +41,7 @@ async def get_user_profile(user_id: int):
     summary="Get current user",
     tags=["users"],
 )
-async def get_user(current_user: User = Depends(get_current_user)):
+async def get_user(current_user: UserSnapshot = Depends(get_current_user)):
     db_user = current_user
     return UserResponse(
         id=cast(int, db_user.id),
@@ -51,24 +58,30 @@ async def get_user(current_user: User = Depends(get_current_user)):
 )
 async def update_user(
     user_update: UserUpdateInput,
-    current_user: User = Depends(get_current_user),
+    current_user: UserSnapshot = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session),
 ):
-    with Session() as session:
-        if user_update.name is not None:
-            session.query(User).filter_by(id=current_user.id).update(
-                {"name": user_update.name}
-            )
-        if user_update.email is not None:
-            session.query(User).filter_by(id=current_user.id).update(
-                {"email": user_update.email}
-            )
-        if user_update.password is not None:
-            hashed_password = pwd_context.hash(user_update.password)
-            session.query(User).filter_by(id=current_user.id).update(
-                {"hashed_password": hashed_password}
-            )
-        session.commit()
-        return
+    # Hashed before any update, which would hold the row lock meanwhile.
+    hashed_password = None
+    if user_update.password is not None:
+        hashed_password = await password_hasher.hash(user_update.password)
+    if user_update.name is not None:
+        await session.execute(
+            update(User).filter_by(id=current_user.id).values(name=user_update.name)
+        )
+    if user_update.email is not None:
+        await session.execute(
+            update(User).filter_by(id=current_user.id).values(email=user_update.email)
+        )
+    if hashed_password is not None:
+        await session.execute(
+            update(User)
+            .filter_by(id=current_user.id)
+            .values(hashed_password=hashed_password)
+        )
+    await session.commit()
+    user_cache.invalidate(current_user.email)
+    return
 
 
 @router.delete(
@@ -78,9 +91,56 @@ async def update_user(
     tags=["users"],
 )
 async def delete_user(
-    current_user: User = Depends(get_current_user),
+    current_user: UserSnapshot = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session),
 ):
-    with Session() as session:
-        session.query(User).filter_by(id=current_user.id).delete()
-        session.commit()
-        return
+    user: User | None = await session.scalar(select(User).filter_by(id=current_user.id))
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    poll_ids = set(await session.scalars(select(Poll.id).filter_by(user_id=user.id)))
+    # Their votes on the polls of others come off those polls' counters.
+    votes = (
+        await session.execute(
+            select(Vote.poll_id, Vote.option_id, Vote.created_at)
+            .join(Poll, Poll.id == Vote.poll_id)
+            .where(Vote.user_id == user.id, Poll.user_id != user.id)
+        )
+    ).all()
+    voted = {poll_id for poll_id, _, _ in votes}
+    # Options before polls and in id order, like their other writers, so the
+    # cascade below cannot deadlock with them.
+    await session.execute(
+        select(Option.id)
+        .where(Option.poll_id.in_(poll_ids | voted))
+        .order_by(Option.id)
+        .with_for_update()
+    )
+    await session.execute(
+        select(Poll.id)
+        .where(Poll.id.in_(poll_ids | voted))
+        .order_by(Poll.id)
+        .with_for_update()
+    )
+    withdrawn = Counter(option_id for _, option_id, _ in votes)
+    if withdrawn:
+        counts = values(
+            column("option_id", Integer), column("votes", Integer), name="withdrawn"
+        ).data(list(withdrawn.items()))
+        await session.execute(
+            update(Option)
+            .where(Option.id == counts.c.option_id)
+            .values(votes_count=Option.votes_count - counts.c.votes)
+        )
+        await session.execute(bump_versions(voted))
+    # The ORM cascade takes their polls and votes with them, the foreign keys
+    # do not cascade.
+    await session.delete(user)
+    await session.commit()
+    user_cache.invalidate(current_user.email)
+    for poll_id, option_id, created_at in votes:
+        striped_counters.forget(option_id)
+        vote_rollup_aggregator.touch(poll_id, created_at)
+        poll_cache.invalidate(poll_id)
+    for poll_id in poll_ids:
+        poll_cache.invalidate(poll_id)
+    return
@@ -1,17 +1,73 @@
-from typing import cast
+import csv
+import io
+from datetime import datetime
+from typing import AsyncIterator, Literal, cast
 
+import orjson
 from fastapi import (APIRouter, Depends, HTTPException, WebSocket,
                      WebSocketDisconnect, status)
+from fastapi.responses import StreamingResponse
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.db import Session
-from app.dependencies import get_current_user
-from app.models import OptionResponse, PollResponse, VoteResponse
-from app.schemas import Option, Poll, User, Vote
-from app.ws import ws_manager
+from app.config import settings
+from app.db import AsyncSessionLocal
+from app.dependencies import get_current_user, get_session
+from app.models import (TimelinePoint, TimelineResponse, VoteBatchInput,
+                        VoteBatchResponse, VoteBatchResult, VoteResponse)
+from app.poll_cache import load_poll, poll_cache
+from app.schemas import Poll, Vote, VoteRollup
+from app.user_cache import UserSnapshot
+from app.voting import VoteOutcome, cast_vote, cast_votes, withdraw_vote
+from app.ws import negotiate_protocol, ws_manager
 
 router = APIRouter()
 
 
+async def publish(event: str, outcome: VoteOutcome, current_user: UserSnapshot):
+    """Tell subscribers and the poll cache about a committed vote change.
+
+    Returns the vote as sent to the subscribers.
+    """
+    poll_id = cast(int, outcome.poll_id)
+    # Plain dicts, the broadcast encodes them once for every subscriber.
+    vote_data = {
+        "id": outcome.vote_id,
+        "user_id": outcome.user_id,
+        "poll_id": outcome.poll_id,
+        "option_id": outcome.option_id,
+    }
+    option_data = {
+        "id": outcome.option_id,
+        "title": outcome.title,
+        "description": outcome.description,
+        "votes_count": outcome.votes_count,
+    }
+    user_data = {
+        "id": current_user.id,
+        "username": current_user.name,
+    }
+    await ws_manager.broadcast(
+        poll_id,
+        {
+            "event": event,
+            "data": {
+                "vote": vote_data,
+                "option": option_data,
+                "user": user_data,
+            },
+        },
+        key=outcome.option_id,
+    )
+    ws_manager.record_counts(
+        poll_id, {cast(int, outcome.option_id): cast(int, outcome.votes_count)}
+    )
+    poll_cache.patch_count(
+        poll_id, cast(int, outcome.option_id), cast(int, outcome.votes_count)
+    )
+    return vote_data
+
+
 @router.post(
     "/polls/{poll_id}/options/{option_id}/vote",
     status_code=status.HTTP_201_CREATED,
@@ -20,51 +76,21 @@ router = APIRouter()
     tags=["votes"],
 )
 async def vote(
-    poll_id: int, option_id: int, current_user: User = Depends(get_current_user)
+    poll_id: int,
+    option_id: int,
+    current_user: UserSnapshot = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session),
 ):
-    with Session() as session:
-        poll: Poll | None = session.query(Poll).filter_by(id=poll_id).first()
-        if not poll:
-            raise HTTPException(status_code=404, detail="Poll not found")
-        option: Option | None = session.query(Option).filter_by(id=option_id).first()
-        if not option or option.poll_id != poll_id:
-            raise HTTPException(status_code=404, detail="Option not found")
-        new_vote = Vote(user_id=current_user.id, poll_id=poll_id, option_id=option_id)
-        session.add(new_vote)
-        session.query(Option).filter_by(id=option_id).update(
-            {"votes_count": cast(int, option.votes_count) + 1}
-        )
-        session.commit()
-        session.refresh(new_vote)
-        session.refresh(option)
-        vote_response = VoteResponse(
-            id=cast(int, new_vote.id),
-            user_id=cast(int, new_vote.user_id),
-            poll_id=cast(int, new_vote.poll_id),
-            option_id=cast(int, new_vote.option_id),
+    outcome = await cast_vote(session, cast(int, current_user.id), poll_id, option_id)
+    if not outcome.poll_found:
+        raise HTTPException(status_code=404, detail="Poll not found")
+    if not outcome.option_found:
+        raise HTTPException(status_code=404, detail="Option not found")
+    if outcome.vote_id is None:
+        raise HTTPException(
+            status_code=409, detail="You have already voted in this poll"
         )
-        option_response = OptionResponse(
-            id=cast(int, option.id),
-            title=cast(str, option.title),
-            description=cast(str, option.description),
-            votes_count=cast(int, option.votes_count),
-        )
-        user_response = {
-            "id": cast(int, current_user.id),
-            "username": cast(str, current_user.username),
-        }
-        await ws_manager.broadcast(
-            poll_id,
-            {
-                "event": "vote",
-                "data": {
-                    "vote": vote_response,
-                    "option": option_response,
-                    "user": user_response,
-                },
-            },
-        )
-        return vote_response
+    return await publish("vote", outcome, current_user)
 
 
 @router.delete(
@@ -74,100 +100,258 @@ async def vote(
     tags=["votes"],
 )
 async def delete_vote(
-    poll_id: int, option_id: int, current_user: User = Depends(get_current_user)
+    poll_id: int,
+    option_id: int,
+    current_user: UserSnapshot = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session),
 ):
-    with Session() as session:
-        poll: Poll | None = session.query(Poll).filter_by(id=poll_id).first()
-        if not poll:
-            raise HTTPException(status_code=404, detail="Poll not found")
-        option: Option | None = session.query(Option).filter_by(id=option_id).first()
-        if not option:
-            raise HTTPException(status_code=404, detail="Option not found")
-        vote: Vote | None = (
-            session.query(Vote)
-            .filter_by(user_id=current_user.id, poll_id=poll_id, option_id=option_id)
-            .first()
-        )
-        if not vote:
-            raise HTTPException(status_code=404, detail="Vote not found")
-        session.delete(vote)
-        session.query(Option).filter_by(id=option_id).update(
-            {"votes_count": cast(int, option.votes_count) - 1}
+    outcome = await withdraw_vote(
+        session, cast(int, current_user.id), poll_id, option_id
+    )
+    if not outcome.poll_found:
+        raise HTTPException(status_code=404, detail="Poll not found")
+    if not outcome.option_found:
+        raise HTTPException(status_code=404, detail="Option not found")
+    if outcome.vote_id is None:
+        raise HTTPException(status_code=404, detail="Vote not found")
+    await publish("delete", outcome, current_user)
+    return
+
+
+@router.post(
+    "/votes/batch",
+    status_code=status.HTTP_200_OK,
+    response_model=VoteBatchResponse,
+    summary="Vote for many poll options",
+    tags=["votes"],
+)
+async def vote_batch(
+    batch: VoteBatchInput,
+    current_user: UserSnapshot = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session),
+):
+    """Cast votes of the current user in many polls at once.
+
+    Every vote gets its own result; the votes that went in are recorded in a
+    single transaction and each affected poll gets one broadcast.
+    """
+    if len(batch.votes) > settings.vote_batch_max_size:
+        raise HTTPException(
+            status_code=422,
+            detail=f"A batch holds at most {settings.vote_batch_max_size} votes",
         )
-        session.commit()
-        session.refresh(option)
-        vote_response = VoteResponse(
-            id=cast(int, vote.id),
-            user_id=cast(int, vote.user_id),
-            poll_id=cast(int, vote.poll_id),
-            option_id=cast(int, vote.option_id),
+    results: list[VoteBatchResult] = []
+    if not batch.votes:
+        return VoteBatchResponse(results=results)
+    outcomes = await cast_votes(
+        session,
+        cast(int, current_user.id),
+        [(vote.poll_id, vote.option_id) for vote in batch.votes],
+    )
+    for vote, outcome in zip(batch.votes, outcomes):
+        if not outcome.poll_found:
+            result_status = "poll_not_found"
+        elif not outcome.option_found:
+            result_status = "option_not_found"
+        elif outcome.vote_id is None:
+            result_status = "already_voted"
+        else:
+            result_status = "created"
+            # At most one vote per poll goes in, this is the poll's only frame.
+            await publish("vote", outcome, current_user)
+        results.append(
+            VoteBatchResult(
+                poll_id=vote.poll_id,
+                option_id=vote.option_id,
+                status=result_status,
+                vote_id=outcome.vote_id,
+            )
         )
-        option_response = OptionResponse(
-            id=cast(int, option.id),
-            title=cast(str, option.title),
-            description=cast(str, option.description),
-            votes_count=cast(int, option.votes_count),
+    return VoteBatchResponse(results=results)
+
+
+EXPORT_COLUMNS = ("id", "user_id", "poll_id", "option_id", "created_at")
+
+
+def export_query(poll_id: int):
+    return (
+        select(Vote.id, Vote.user_id, Vote.poll_id, Vote.option_id, Vote.created_at)
+        .filter_by(poll_id=poll_id)
+        .order_by(Vote.id)
+    )
+
+
+def timeline_query(
+    poll_id: int, granularity: str, since: datetime | None, until: datetime | None
+):
+    bucket = func.date_trunc(granularity, VoteRollup.bucket).label("bucket")
+    query = select(
+        bucket, VoteRollup.option_id, func.sum(VoteRollup.votes_count)
+    ).filter(VoteRollup.poll_id == poll_id)
+    if since is not None:
+        query = query.filter(VoteRollup.bucket >= since)
+    if until is not None:
+        query = query.filter(VoteRollup.bucket < until)
+    return query.group_by(bucket, VoteRollup.option_id).order_by(
+        bucket, VoteRollup.option_id
+    )
+
+
+async def export_votes(poll_id: int, format: str) -> AsyncIterator[bytes]:
+    """Encode the votes of a poll chunk by chunk from a server-side cursor."""
+    if format == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_COLUMNS)
+        yield buffer.getvalue().encode()
+    # The request session is gone by the time the body is sent, and a
+    # server-side cursor needs its own transaction anyway.
+    async with AsyncSessionLocal() as session:
+        result = await session.stream(
+            export_query(poll_id).execution_options(
+                yield_per=settings.vote_export_batch_size
+            )
         )
-        user_response = {
-            "id": cast(int, current_user.id),
-            "username": cast(str, current_user.username),
-        }
-        await ws_manager.broadcast(
-            poll_id,
-            {
-                "event": "delete",
-                "data": {
-                    "vote": vote_response,
-                    "option": option_response,
-                    "user": user_response,
-                },
-            },
+        async for rows in result.partitions():
+            if format == "csv":
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+                writer.writerows(rows)
+                yield buffer.getvalue().encode()
+            else:
+                yield b"".join(
+                    orjson.dumps(dict(zip(EXPORT_COLUMNS, row))) + b"\n"
+                    for row in rows
+                )
+
+
+@router.get(
+    "/polls/{poll_id}/votes/export",
+    status_code=status.HTTP_200_OK,
+    summary="Export poll votes",
+    tags=["votes"],
+    response_class=StreamingResponse,
+)
+async def export_poll_votes(
+    poll_id: int,
+    format: Literal["csv", "ndjson"] = "csv",
+    current_user: UserSnapshot = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session),
+):
+    poll: Poll | None = await session.scalar(select(Poll).filter_by(id=poll_id))
+    if not poll:
+        raise HTTPException(status_code=404, detail="Poll not found")
+    if poll.user_id != current_user.id:
+        raise HTTPException(
+            status_code=403, detail="You are not authorized to export this poll"
         )
-        return
+    await session.close()
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        export_votes(poll_id, format),
+        media_type=media_type,
+        headers={
+            "Content-Disposition": (
+                f'attachment; filename="poll-{poll_id}-votes.{format}"'
+            )
+        },
+    )
+
+
+@router.get(
+    "/polls/{poll_id}/timeline",
+    response_model=TimelineResponse,
+    status_code=status.HTTP_200_OK,
+    summary="Get poll votes over time",
+    tags=["votes"],
+)
+async def get_timeline(
+    poll_id: int,
+    granularity: Literal["minute", "hour", "day"] = "hour",
+    since: datetime | None = None,
+    until: datetime | None = None,
+    session: AsyncSession = Depends(get_session),
+):
+    """Votes per option and time bucket, by the time they were cast.
+
+    Served from the per-minute rollups, withdrawn votes are removed from the
+    bucket they were cast in. The rollups are re-counted in the background
+    and trail the votes by up to `VOTE_ROLLUP_INTERVAL_MS`.
+    """
+    if await session.scalar(select(Poll.id).filter_by(id=poll_id)) is None:
+        raise HTTPException(status_code=404, detail="Poll not found")
+    rows = await session.execute(timeline_query(poll_id, granularity, since, until))
+    return TimelineResponse(
+        poll_id=poll_id,
+        granularity=granularity,
+        points=[
+            TimelinePoint(bucket=row[0], option_id=row[1], votes_count=row[2])
+            for row in rows
+        ],
+    )
 
 
 @router.websocket("/polls/{poll_id}")
 async def vote_websocket(
     websocket: WebSocket,
     poll_id: int,
-    _: User = Depends(get_current_user),
+    mode: Literal["events", "deltas"] = "events",
+    _: UserSnapshot = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session),
 ):
-    poll: Poll | None = None
-    options: list[Option] = []
-    with Session() as session:
-        poll = session.query(Poll).filter_by(id=poll_id).first()
-        if not poll:
-            await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
-            return
-        options = session.query(Option).filter_by(poll_id=poll_id).all()
-    await websocket.accept()
-    await ws_manager.connect(poll_id, websocket)
-    poll_response = PollResponse(
-        id=cast(int, poll.id),
-        title=cast(str, poll.title),
-        description=cast(str, poll.description),
-        user_id=cast(int, poll.user_id),
-        options=[
-            OptionResponse(
-                id=cast(int, option.id),
-                title=cast(str, option.title),
-                description=cast(str, option.description),
-                votes_count=cast(int, option.votes_count),
-            )
-            for option in options
+    poll = await load_poll(session, poll_id)
+    if not poll:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    # Release the connection back to the pool, the socket may stay open for hours.
+    await session.close()
+    protocol, subprotocol = negotiate_protocol(websocket)
+    await websocket.accept(subprotocol=subprotocol)
+    await ws_manager.connect(poll_id, websocket, mode, protocol)
+    poll_data = {
+        "id": poll.id,
+        "title": poll.title,
+        "description": poll.description,
+        "user_id": poll.user_id,
+        "options": [
+            {
+                "id": option.id,
+                "title": option.title,
+                "description": option.description,
+                "votes_count": option.votes_count,
+            }
+            for option in poll.options
         ],
-    )
+    }
     try:
-        await ws_manager.broadcast(
-            poll_id,
-            {
-                "event": "connect",
-                "data": {
-                    "poll": poll_response,
+        if mode == "deltas":
+            await ws_manager.send(
+                poll_id,
+                websocket,
+                {
+                    "event": "connect",
+                    "seq": ws_manager.sequence(poll_id),
+                    "data": {
+                        "poll": poll_data,
+                    },
                 },
-            },
-        )
+            )
+        else:
+            await ws_manager.broadcast(
+                poll_id,
+                {
+                    "event": "connect",
+                    "data": {
+                        "poll": poll_data,
+                    },
+                },
+            )
         while True:
-            await websocket.receive_text()
+            # Binary subprotocol clients may send bytes, so do not expect text.
+            if (await websocket.receive())["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect()
     except WebSocketDisconnect:
+        pass
+    finally:
+        # Whatever ended the socket, stop its sender and drop its frames.
         await ws_manager.disconnect(poll_id, websocket)
@@ -1,4 +1,5 @@
-from sqlalchemy import Column, ForeignKey, Integer, String
+from sqlalchemy import (Column, DateTime, ForeignKey, Index, Integer, String,
+                        UniqueConstraint, func)
 from sqlalchemy.orm import relationship
 
 from .db import Base
@@ -17,11 +18,14 @@ class User(Base):
 
 class Poll(Base):
     __tablename__ = "polls"
+    __table_args__ = (Index("ix_polls_user_id_id", "user_id", "id"),)
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     title = Column(String, nullable=False)
     description = Column(String, nullable=False)
     user_id = Column(Integer, ForeignKey("users.id"))
+    # Bumped by every change to the poll, its options or its votes.
+    version = Column(Integer, nullable=False, default=0, server_default="0")
     user = relationship("User", back_populates="polls")
     options = relationship(
         "Option", back_populates="poll", cascade="all, delete-orphan"
@@ -31,6 +35,7 @@ class Poll(Base):
 
 class Option(Base):
     __tablename__ = "options"
+    __table_args__ = (Index("ix_options_poll_id", "poll_id"),)
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     title = Column(String, nullable=False)
@@ -39,15 +44,55 @@ class Option(Base):
     poll = relationship("Poll", back_populates="options")
     votes = relationship("Vote", back_populates="option", cascade="all, delete-orphan")
     votes_count = Column(Integer, nullable=False, default=0)
+    vote_slots = relationship(
+        "OptionVoteSlot", back_populates="option", cascade="all, delete-orphan"
+    )
+    rollups = relationship(
+        "VoteRollup", back_populates="option", cascade="all, delete-orphan"
+    )
+
+
+class OptionVoteSlot(Base):
+    __tablename__ = "option_vote_slots"
+
+    option_id = Column(Integer, ForeignKey("options.id"), primary_key=True)
+    slot = Column(Integer, primary_key=True)
+    votes_count = Column(Integer, nullable=False, default=0)
+    option = relationship("Option", back_populates="vote_slots")
 
 
 class Vote(Base):
     __tablename__ = "votes"
+    __table_args__ = (
+        UniqueConstraint("user_id", "poll_id", name="votes_user_id_poll_id_key"),
+        Index("ix_votes_poll_id_id", "poll_id", "id"),
+        Index("ix_votes_option_id", "option_id"),
+        Index("ix_votes_created_at", "created_at"),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     poll_id = Column(Integer, ForeignKey("polls.id"))
     option_id = Column(Integer, ForeignKey("options.id"))
+    created_at = Column(
+        DateTime(timezone=True), nullable=False, server_default=func.now()
+    )
     user = relationship("User")
     poll = relationship("Poll")
     option = relationship("Option")
+
+
+class VoteRollup(Base):
+    """Votes of an option per minute they were cast in, re-counted from the votes."""
+
+    __tablename__ = "vote_rollups"
+    __table_args__ = (
+        Index("ix_vote_rollups_option_id", "option_id"),
+        Index("ix_vote_rollups_bucket", "bucket"),
+    )
+
+    poll_id = Column(Integer, ForeignKey("polls.id"), primary_key=True)
+    option_id = Column(Integer, ForeignKey("options.id"), primary_key=True)
+    bucket = Column(DateTime(timezone=True), primary_key=True)
+    votes_count = Column(Integer, nullable=False, default=0)
+    option = relationship("Option", back_populates="rollups")
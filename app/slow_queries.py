@@ -0,0 +1,162 @@
+import asyncio
+import logging
+import random
+import re
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+# Locking clauses and calls whose effects EXPLAIN ANALYZE would run for real,
+# rolling its transaction back neither releases session advisory locks nor
+# takes back a notification or a sequence value.
+SIDE_EFFECTS = re.compile(
+    r"\bFOR\s+(UPDATE|NO\s+KEY\s+UPDATE|SHARE|KEY\s+SHARE)\b"
+    r"|\b(pg_(try_)?advisory_\w+|pg_notify|nextval|setval|set_config|pg_sleep\w*"
+    r"|pg_cancel_backend|pg_terminate_backend|lo_\w+|dblink\w*)\s*\(",
+    re.IGNORECASE,
+)
+
+
+@dataclass(slots=True)
+class SlowQuery:
+    statement: str
+    # Types of the bound parameters only, their values may be sensitive.
+    parameters: str
+    duration: float
+    recorded_at: datetime
+
+
+@dataclass(slots=True)
+class QueryPlan:
+    plan: str
+    analyzed: bool
+
+
+def analyzable(statement: str) -> bool:
+    """Whether running the statement under EXPLAIN ANALYZE only reads."""
+    if not statement.lstrip().upper().startswith("SELECT"):
+        return False
+    return SIDE_EFFECTS.search(statement) is None
+
+
+def parameter_shape(parameters: Any, executemany: bool) -> str:
+    if executemany:
+        rows = list(parameters)
+        first = parameter_shape(rows[0], False) if rows else "()"
+        return f"{len(rows)} x {first}"
+    if isinstance(parameters, dict):
+        return str({key: type(value).__name__ for key, value in parameters.items()})
+    return f"({', '.join(type(value).__name__ for value in parameters or ())})"
+
+
+class SlowQueryLog:
+    """Ring of the latest statements slower than a threshold, with their plans.
+
+    Timing a statement costs a timestamp and a comparison, anything more
+    only happens to slow ones. The first time a statement is seen slow its
+    plan is captured in the background with `EXPLAIN`, or with `EXPLAIN
+    ANALYZE` for a sample of the SELECT statements that only read, see
+    `analyzable`. The plan runs in a transaction that is rolled back.
+    """
+
+    def __init__(self, threshold_ms: int, size: int, analyze_sample: float):
+        self.threshold = threshold_ms / 1000
+        self.analyze_sample = analyze_sample
+        self.entries: deque[SlowQuery] = deque(maxlen=size)
+        # Statements explained or waiting to be, None until the plan is in.
+        self.plans: OrderedDict[str, QueryPlan | None] = OrderedDict()
+        self.max_plans = size
+        self.pending: deque[tuple[str, Any]] = deque(maxlen=size)
+        self.engine: AsyncEngine | None = None
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def install(self, engine: AsyncEngine):
+        self.engine = engine
+        event.listen(engine.sync_engine, "before_cursor_execute", self._before)
+        event.listen(engine.sync_engine, "after_cursor_execute", self._after)
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        context._slow_query_started = time.perf_counter()
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - context._slow_query_started
+        if duration >= self.threshold:
+            self.record(statement, parameters, duration, executemany)
+
+    def record(self, statement: str, parameters: Any, duration: float, many: bool):
+        if statement.startswith("EXPLAIN"):
+            # Our own plan captures, EXPLAIN ANALYZE is as slow as the query.
+            return
+        self.entries.append(
+            SlowQuery(
+                statement=statement,
+                parameters=parameter_shape(parameters, many),
+                duration=duration,
+                recorded_at=datetime.now(timezone.utc),
+            )
+        )
+        if statement in self.plans or many:
+            return
+        self.plans[statement] = None
+        while len(self.plans) > self.max_plans:
+            self.plans.popitem(last=False)
+        self.pending.append((statement, parameters))
+        self._wakeup.set()
+
+    async def start(self):
+        self._wakeup = asyncio.Event()
+        if self.pending:
+            self._wakeup.set()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def explain(self, statement: str, parameters: Any) -> QueryPlan:
+        assert self.engine is not None
+        analyze = analyzable(statement) and random.random() < self.analyze_sample
+        prefix = "EXPLAIN (ANALYZE, BUFFERS) " if analyze else "EXPLAIN "
+        # Leaving the block without committing rolls the transaction back.
+        async with self.engine.connect() as connection:
+            result = await connection.exec_driver_sql(prefix + statement, parameters)
+            return QueryPlan(
+                plan="\n".join(row[0] for row in result), analyzed=analyze
+            )
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self.pending:
+                statement, parameters = self.pending.popleft()
+                try:
+                    plan = await self.explain(statement, parameters)
+                except Exception as error:
+                    logger.exception("Failed to explain a slow statement")
+                    plan = QueryPlan(plan=f"EXPLAIN failed: {error}", analyzed=False)
+                if statement in self.plans:
+                    self.plans[statement] = plan
+
+
+slow_query_log = SlowQueryLog(
+    settings.slow_query_threshold_ms,
+    settings.slow_query_log_size,
+    settings.slow_query_analyze_sample,
+)
@@ -0,0 +1,118 @@
+import logging
+import time
+from collections import Counter as Tally
+from contextvars import ContextVar
+
+from prometheus_client import Counter, Histogram
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from starlette.routing import Match
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+db_queries_per_request = Histogram(
+    "db_queries_per_request",
+    "SQL statements executed while serving a request",
+    ["route"],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144),
+)
+db_seconds_per_request = Histogram(
+    "db_seconds_per_request",
+    "Time spent executing SQL statements while serving a request",
+    ["route"],
+)
+db_repeated_statements = Counter(
+    "db_repeated_statements",
+    "Requests that ran the same statement more often than allowed",
+    ["route"],
+)
+
+
+class RepeatedStatementError(Exception):
+    """A request ran the same statement shape more often than allowed."""
+
+
+class RequestQueries:
+    """SQL statements run on behalf of the current request."""
+
+    __slots__ = ("count", "seconds", "shapes", "repeated")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.shapes: Tally[str] = Tally()
+        self.repeated = False
+
+
+current_queries: ContextVar[RequestQueries | None] = ContextVar(
+    "current_queries", default=None
+)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_queries.get() is not None:
+        context._query_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    queries = current_queries.get()
+    if queries is None:
+        return
+    queries.count += 1
+    queries.seconds += time.perf_counter() - context._query_started
+    # Parameters are bound separately, the SQL text is the statement shape.
+    repeats = queries.shapes[statement] = queries.shapes[statement] + 1
+    if repeats != settings.sql_repeat_threshold + 1:
+        return
+    queries.repeated = True
+    message = f"Statement ran more than {settings.sql_repeat_threshold} times"
+    if settings.sql_repeat_action == "raise":
+        raise RepeatedStatementError(f"{message}: {statement}")
+    if settings.sql_repeat_action == "warn":
+        logger.warning("%s in one request: %s", message, statement)
+
+
+def instrument_engine(engine: AsyncEngine):
+    event.listen(engine.sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine.sync_engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def route_name(scope: Scope) -> str:
+    """The method and path template of the matched route, e.g. `POST /polls`."""
+    # Recent Starlette versions record the matched route in the scope.
+    route = scope.get("route")
+    if route is None:
+        for candidate in scope["app"].routes:
+            if candidate.matches(scope)[0] == Match.FULL:
+                route = candidate
+                break
+    if route is None:
+        # Unmatched requests share one series whatever their method.
+        return "unmatched"
+    return f"{scope['method']} {route.path}"
+
+
+class SQLStatsMiddleware:
+    """Attributes the SQL statements of every HTTP request to its route."""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        queries = RequestQueries()
+        token = current_queries.set(queries)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_queries.reset(token)
+            route = route_name(scope)
+            db_queries_per_request.labels(route).observe(queries.count)
+            db_seconds_per_request.labels(route).observe(queries.seconds)
+            if queries.repeated:
+                db_repeated_statements.labels(route).inc()
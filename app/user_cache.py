@@ -0,0 +1,66 @@
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from prometheus_client import Counter
+
+from .config import settings
+
+user_cache_hits = Counter(
+    "user_cache_hits", "Authenticated user lookups served from the cache"
+)
+user_cache_misses = Counter(
+    "user_cache_misses", "Authenticated user lookups that went to the database"
+)
+user_cache_evictions = Counter(
+    "user_cache_evictions", "Users evicted from the cache to stay within its size"
+)
+
+
+@dataclass(frozen=True, slots=True)
+class UserSnapshot:
+    id: int
+    name: str
+    email: str
+
+
+class UserCache:
+    """Bounded TTL and LRU cache of authenticated users keyed by token subject.
+
+    Invalidation only reaches the current process, other workers keep serving
+    their entry until it expires, so the TTL bounds how long a changed or
+    deleted account can still be seen by them.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl = ttl_seconds
+        self.entries: OrderedDict[str, tuple[float, UserSnapshot]] = OrderedDict()
+        # Bumped on every invalidation so that a lookup which raced with it
+        # does not put the stale user back.
+        self.generation = 0
+
+    def get(self, subject: str) -> UserSnapshot | None:
+        entry = self.entries.get(subject)
+        if entry is None or entry[0] <= time.monotonic():
+            user_cache_misses.inc()
+            return None
+        self.entries.move_to_end(subject)
+        user_cache_hits.inc()
+        return entry[1]
+
+    def put(self, subject: str, user: UserSnapshot, generation: int):
+        if generation != self.generation:
+            return
+        self.entries[subject] = (time.monotonic() + self.ttl, user)
+        self.entries.move_to_end(subject)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            user_cache_evictions.inc()
+
+    def invalidate(self, subject: str):
+        self.generation += 1
+        self.entries.pop(subject, None)
+
+
+user_cache = UserCache(settings.user_cache_size, settings.user_cache_ttl_seconds)
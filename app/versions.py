@@ -0,0 +1,184 @@
+import asyncio
+import logging
+from hashlib import blake2b
+from typing import Iterable
+
+from fastapi import Request, Response, status
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .config import settings
+from .db import AdvisoryLock, AsyncSessionLocal
+from .poll_cache import poll_cache, reload_polls
+from .schemas import Poll, Vote
+
+logger = logging.getLogger(__name__)
+
+
+def bump_version(poll_id: int):
+    """Statement marking a poll as changed, run it in the writing transaction."""
+    return update(Poll).filter_by(id=poll_id).values(version=Poll.version + 1)
+
+
+def bump_versions(poll_ids: Iterable[int]):
+    """Statement bumping the versions of many polls, returns the new versions."""
+    # Locked in id order, so workers bumping the same polls cannot deadlock.
+    locked = (
+        select(Poll.id)
+        .where(Poll.id.in_(poll_ids))
+        .order_by(Poll.id)
+        .with_for_update()
+        .cte("locked")
+    )
+    return (
+        update(Poll)
+        .where(Poll.id == locked.c.id)
+        .values(version=Poll.version + 1)
+        .returning(Poll.id, Poll.version)
+    )
+
+
+class PollVersionBumper:
+    """Bumps the versions of polls whose votes changed, once per tick.
+
+    Votes never write the poll row, that would serialise every vote of a
+    poll on its lock. They touch the poll once committed and every
+    `interval_ms` the touched polls get one version bump in a single
+    statement, so the ETag of a poll lags its vote counts by at most one
+    tick but a version never labels counts older than itself. The cached
+    snapshots of the bumped polls are then read again.
+
+    Touched polls only live in memory. So that a worker dying before its
+    tick cannot leave a poll on its old version for good, one worker,
+    elected with an advisory lock, also touches the polls of the votes
+    recorded past a watermark on `votes.id`, starting `scan_size` votes
+    back when it takes over. A vote may thus bump its poll twice, which
+    costs a client one more full response at worst. Withdrawn votes leave
+    no row to scan and stay on their worker.
+
+    Buffered counters reach the database later, the buffer bumps the
+    versions of the polls it flushes instead and votes touch nothing here.
+    """
+
+    def __init__(self, interval_ms: int, scan_size: int):
+        self.interval = interval_ms / 1000
+        self.scan_size = scan_size
+        self.pending: set[int] = set()
+        self.watermark: int | None = None
+        self.runner = AdvisoryLock("poll_versions.runner")
+        self._task: asyncio.Task | None = None
+
+    def touch(self, poll_id: int):
+        self.pending.add(poll_id)
+
+    async def scan(self):
+        """Touch the polls of the votes recorded since the watermark."""
+        async with AsyncSessionLocal() as session:
+            if self.watermark is None:
+                newest = await session.scalar(select(func.max(Vote.id))) or 0
+                self.watermark = max(newest - self.scan_size, 0)
+            votes = (
+                await session.execute(
+                    select(Vote.id, Vote.poll_id)
+                    .where(Vote.id > self.watermark)
+                    .order_by(Vote.id)
+                    .limit(self.scan_size)
+                )
+            ).all()
+        for vote_id, poll_id in votes:
+            self.pending.add(poll_id)
+            self.watermark = vote_id
+
+    async def flush(self):
+        if settings.vote_counter_mode != "buffered" and await self.runner.acquire():
+            await self.scan()
+        else:
+            self.watermark = None
+        if not self.pending:
+            return
+        poll_ids, self.pending = self.pending, set()
+        try:
+            async with AsyncSessionLocal() as session:
+                bumped = (await session.execute(bump_versions(poll_ids))).all()
+                await session.commit()
+        except BaseException:
+            self.pending.update(poll_ids)
+            raise
+        async with AsyncSessionLocal() as session:
+            await reload_polls(session, [poll_id for poll_id, _ in bumped])
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        try:
+            await self.flush()
+        finally:
+            self.watermark = None
+            await self.runner.release()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to bump poll versions, retrying later")
+
+
+async def poll_version(session: AsyncSession, poll_id: int) -> int | None:
+    """Current version of a poll without loading its options."""
+    snapshot = poll_cache.peek(poll_id)
+    if snapshot is not None:
+        return snapshot.version
+    return await session.scalar(select(Poll.version).filter_by(id=poll_id))
+
+
+def poll_etag(version: int) -> str:
+    return f'"{version}"'
+
+
+def page_etag(polls: Iterable[tuple[int, int]], has_more: bool) -> str:
+    digest = blake2b(digest_size=12)
+    for poll_id, version in polls:
+        digest.update(f"{poll_id}:{version},".encode())
+    digest.update(b"+" if has_more else b".")
+    return f'"{digest.hexdigest()}"'
+
+
+async def revalidate_poll(
+    request: Request, session: AsyncSession, poll_id: int
+) -> Response | None:
+    """A 304 response when the client holds the current version of the poll."""
+    if "if-none-match" not in request.headers:
+        return None
+    version = await poll_version(session, poll_id)
+    if version is None:
+        return None
+    return not_modified(request, poll_etag(version))
+
+
+def not_modified(request: Request, etag: str) -> Response | None:
+    """A 304 response when the client already holds the `etag` representation."""
+    header = request.headers.get("if-none-match")
+    if header is None:
+        return None
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    if "*" in tags or etag in tags:
+        return Response(
+            status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag}
+        )
+    return None
+
+
+poll_version_bumper = PollVersionBumper(
+    settings.poll_version_interval_ms, settings.poll_version_scan_size
+)
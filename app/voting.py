@@ -0,0 +1,299 @@
+import random
+from datetime import datetime
+from typing import NamedTuple, cast
+
+from sqlalchemy import (Integer, column, delete, exists, func, literal, select,
+                        true, update, values)
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .config import settings
+from .counters import striped_counters, vote_counter_buffer
+from .reconciler import vote_reconciler
+from .rollups import vote_rollup_aggregator
+from .schemas import Option, OptionVoteSlot, Poll, Vote
+from .versions import poll_version_bumper
+
+
+class VoteOutcome(NamedTuple):
+    poll_found: bool
+    option_found: bool
+    vote_id: int | None
+    user_id: int | None
+    poll_id: int | None
+    option_id: int | None
+    title: str | None
+    description: str | None
+    votes_count: int | None
+    created_at: datetime | None
+
+
+def _lookup(poll_id: int, option_id: int, option_in_poll: bool):
+    option_filter = [Option.id == option_id]
+    if option_in_poll:
+        option_filter.append(Option.poll_id == poll_id)
+    return select(
+        exists().where(Poll.id == poll_id).label("poll_found"),
+        exists().where(*option_filter).label("option_found"),
+    ).subquery("lookup")
+
+
+def _counted(changed, delta: int):
+    columns = (Option.id, Option.title, Option.description, Option.votes_count)
+    if settings.vote_counter_mode == "buffered":
+        # The counter is updated by the write-behind buffer, only read it here.
+        return (
+            select(*columns).where(Option.id == changed.c.option_id).cte("counted")
+        )
+    if settings.vote_counter_mode == "striped":
+        slot = random.randrange(settings.vote_counter_slots)
+        bump = insert(OptionVoteSlot).from_select(
+            ["option_id", "slot", "votes_count"],
+            select(
+                changed.c.option_id, literal(slot, Integer), literal(delta, Integer)
+            ),
+        )
+        bumped = (
+            bump.on_conflict_do_update(
+                index_elements=["option_id", "slot"],
+                set_={
+                    "votes_count": OptionVoteSlot.votes_count
+                    + bump.excluded.votes_count
+                },
+            )
+            .returning(OptionVoteSlot.option_id)
+            .cte("bumped")
+        )
+        # The statement snapshot does not see its own increment, add it back.
+        slots_total = (
+            select(func.coalesce(func.sum(OptionVoteSlot.votes_count), 0))
+            .where(OptionVoteSlot.option_id == Option.id)
+            .scalar_subquery()
+        )
+        return (
+            select(
+                Option.id,
+                Option.title,
+                Option.description,
+                (Option.votes_count + slots_total + delta).label("votes_count"),
+            )
+            .where(Option.id == bumped.c.option_id)
+            .cte("counted")
+        )
+    return (
+        update(Option)
+        .where(Option.id == changed.c.option_id)
+        .values(votes_count=Option.votes_count + delta)
+        .returning(*columns)
+        .cte("counted")
+    )
+
+
+def _outcome(lookup, changed, counted):
+    return (
+        select(
+            lookup.c.poll_found,
+            lookup.c.option_found,
+            changed.c.id.label("vote_id"),
+            changed.c.user_id,
+            changed.c.poll_id,
+            changed.c.option_id,
+            counted.c.title,
+            counted.c.description,
+            counted.c.votes_count,
+            changed.c.created_at,
+        )
+        .select_from(lookup)
+        .outerjoin(
+            changed.join(counted, counted.c.id == changed.c.option_id), true()
+        )
+    )
+
+
+async def _execute(session: AsyncSession, statement, delta: int) -> VoteOutcome:
+    (outcome,) = await _execute_all(session, statement, delta)
+    return outcome
+
+
+async def _execute_all(
+    session: AsyncSession, statement, delta: int
+) -> list[VoteOutcome]:
+    outcomes = [VoteOutcome(*row) for row in (await session.execute(statement))]
+    if all(outcome.vote_id is None for outcome in outcomes):
+        return outcomes
+    await session.commit()
+    for index, outcome in enumerate(outcomes):
+        if outcome.vote_id is None:
+            continue
+        option_id = cast(int, outcome.option_id)
+        stored = cast(int, outcome.votes_count)
+        if settings.vote_counter_mode != "buffered":
+            poll_version_bumper.touch(cast(int, outcome.poll_id))
+        if delta < 0:
+            # New votes are found by scanning, withdrawn ones leave no row.
+            vote_reconciler.touch(option_id)
+            vote_rollup_aggregator.touch(
+                cast(int, outcome.poll_id), cast(datetime, outcome.created_at)
+            )
+        if settings.vote_counter_mode == "striped":
+            striped_counters.record(option_id, stored)
+        if settings.vote_counter_mode == "buffered":
+            vote_counter_buffer.add(option_id, delta)
+            outcomes[index] = outcome._replace(
+                votes_count=vote_counter_buffer.total(option_id, stored)
+            )
+    return outcomes
+
+
+def vote_statement(user_id: int, poll_id: int, option_id: int):
+    target = (
+        select(Option.id, Option.poll_id)
+        .filter_by(id=option_id, poll_id=poll_id)
+        .cte("target")
+    )
+    inserted = (
+        insert(Vote)
+        .from_select(
+            ["user_id", "poll_id", "option_id"],
+            select(literal(user_id, Integer), target.c.poll_id, target.c.id),
+        )
+        .on_conflict_do_nothing(index_elements=["user_id", "poll_id"])
+        .returning(
+            Vote.id, Vote.user_id, Vote.poll_id, Vote.option_id, Vote.created_at
+        )
+        .cte("inserted")
+    )
+    counted = _counted(inserted, 1)
+    lookup = _lookup(poll_id, option_id, option_in_poll=True)
+    return _outcome(lookup, inserted, counted)
+
+
+def batch_vote_statement(user_id: int, votes: list[tuple[int, int]]):
+    rows = [
+        (position, poll_id, option_id)
+        for position, (poll_id, option_id) in enumerate(votes)
+    ]
+    requested = select(
+        values(
+            column("position", Integer),
+            column("poll_id", Integer),
+            column("option_id", Integer),
+            name="requested_votes",
+        ).data(rows)
+    ).cte("requested")
+    # Only the first valid vote per poll can go in, the others of the batch
+    # fail like a second vote in the same poll.
+    target = (
+        select(requested.c.position, Option.id, Option.poll_id)
+        .join(
+            Option,
+            (Option.id == requested.c.option_id)
+            & (Option.poll_id == requested.c.poll_id),
+        )
+        .distinct(Option.poll_id)
+        .order_by(Option.poll_id, requested.c.position)
+        .cte("target")
+    )
+    inserted = (
+        insert(Vote)
+        .from_select(
+            ["user_id", "poll_id", "option_id"],
+            select(literal(user_id, Integer), target.c.poll_id, target.c.id),
+        )
+        .on_conflict_do_nothing(index_elements=["user_id", "poll_id"])
+        .returning(
+            Vote.id, Vote.user_id, Vote.poll_id, Vote.option_id, Vote.created_at
+        )
+        .cte("inserted")
+    )
+    # A user votes once per poll, so every option and poll shows up at most
+    # once in `inserted` and the single vote counters apply row by row.
+    counted = _counted(inserted, 1)
+    return (
+        select(
+            exists().where(Poll.id == requested.c.poll_id).label("poll_found"),
+            exists()
+            .where(
+                Option.id == requested.c.option_id,
+                Option.poll_id == requested.c.poll_id,
+            )
+            .label("option_found"),
+            inserted.c.id.label("vote_id"),
+            inserted.c.user_id,
+            inserted.c.poll_id,
+            inserted.c.option_id,
+            counted.c.title,
+            counted.c.description,
+            counted.c.votes_count,
+            inserted.c.created_at,
+        )
+        .select_from(requested)
+        .outerjoin(target, target.c.position == requested.c.position)
+        .outerjoin(
+            inserted.join(counted, counted.c.id == inserted.c.option_id),
+            inserted.c.poll_id == target.c.poll_id,
+        )
+        .order_by(requested.c.position)
+    )
+
+
+def unvote_statement(user_id: int, poll_id: int, option_id: int):
+    deleted = (
+        delete(Vote)
+        .where(
+            Vote.user_id == user_id,
+            Vote.poll_id == poll_id,
+            Vote.option_id == option_id,
+        )
+        .returning(
+            Vote.id, Vote.user_id, Vote.poll_id, Vote.option_id, Vote.created_at
+        )
+        .cte("deleted")
+    )
+    counted = _counted(deleted, -1)
+    lookup = _lookup(poll_id, option_id, option_in_poll=False)
+    return _outcome(lookup, deleted, counted)
+
+
+async def cast_vote(
+    session: AsyncSession, user_id: int, poll_id: int, option_id: int
+) -> VoteOutcome:
+    """Record a vote and bump the option counter in a single statement.
+
+    The poll version is bumped by the next tick of the version bumper. The
+    transaction is committed when the vote was recorded.
+
+    `vote_id` is None in the outcome when the option does not belong to the
+    poll or the user has already voted in it; `poll_found` and `option_found`
+    tell the two cases apart.
+    """
+    statement = vote_statement(user_id, poll_id, option_id)
+    return await _execute(session, statement, 1)
+
+
+async def cast_votes(
+    session: AsyncSession, user_id: int, votes: list[tuple[int, int]]
+) -> list[VoteOutcome]:
+    """Record many (poll_id, option_id) votes of a user in a single statement.
+
+    Outcomes come back in input order, with the same meaning as for
+    `cast_vote`. A second vote in the same poll, whether already stored or
+    earlier in the batch, gets a None `vote_id`. The transaction is committed
+    when at least one vote was recorded.
+    """
+    statement = batch_vote_statement(user_id, votes)
+    return await _execute_all(session, statement, 1)
+
+
+async def withdraw_vote(
+    session: AsyncSession, user_id: int, poll_id: int, option_id: int
+) -> VoteOutcome:
+    """Delete a vote and decrement the option counter in a single statement.
+
+    The poll version is bumped by the next tick of the version bumper. The
+    transaction is committed when the vote was deleted.
+
+    `vote_id` is None in the outcome when there was no matching vote.
+    """
+    statement = unvote_statement(user_id, poll_id, option_id)
+    return await _execute(session, statement, -1)
@@ -1,27 +1,414 @@
-import json
-from typing import Any
+import asyncio
+import heapq
+import time
+from collections import deque
+from operator import itemgetter
+from typing import Any, Callable
 
-from fastapi import WebSocket
+import msgpack
+import orjson
+from fastapi import WebSocket, status
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+from prometheus_client.core import GaugeMetricFamily
+
+from .backplane import (Envelope, InProcessBackplane, PostgresBackplane,
+                        create_backplane)
+from .config import settings
+
+# Frames queued under the same key can be coalesced, votes use the option id.
+Key = int | str | None
+
+# Subprotocols a client can ask for, in order of preference.
+SUBPROTOCOLS = ("msgpack", "json")
+
+ws_connections = Gauge("ws_connections", "Open WebSocket subscriptions")
+ws_subscribed_polls = Gauge(
+    "ws_subscribed_polls", "Polls with at least one WebSocket subscriber"
+)
+ws_broadcast_seconds = Histogram(
+    "ws_broadcast_seconds",
+    "Time from a broadcast reaching this process until every subscriber was "
+    "sent its frame or gave it up",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+)
+ws_broadcast_fanout = Histogram(
+    "ws_broadcast_fanout",
+    "Subscribers a broadcast frame was queued for",
+    buckets=(0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000),
+)
+ws_send_failures = Counter(
+    "ws_send_failures", "Frames that could not be sent to a socket", ["reason"]
+)
+ws_dropped_frames = Counter(
+    "ws_dropped_frames", "Frames discarded before being sent", ["reason"]
+)
+
+
+def negotiate_protocol(websocket: WebSocket) -> tuple[str, str | None]:
+    """Pick the wire format and the subprotocol to accept the socket with."""
+    requested = websocket.scope.get("subprotocols", [])
+    for subprotocol in SUBPROTOCOLS:
+        if subprotocol in requested:
+            return subprotocol, subprotocol
+    return "json", None
+
+
+class Frame:
+    """A message encoded at most once per wire format, whatever the audience.
+
+    Broadcast frames also count the subscribers they are still queued for,
+    the broadcast is over when the last one sent or discarded the frame.
+    """
+
+    __slots__ = ("message", "encoded", "created", "pending")
+
+    def __init__(self, message: Any):
+        self.message = message
+        self.encoded: dict[str, str | bytes] = {}
+        self.created = time.perf_counter()
+        self.pending: int | None = None
+
+    def broadcast(self, subscribers: int):
+        ws_broadcast_fanout.observe(subscribers)
+        self.pending = (self.pending or 0) + subscribers
+
+    def done(self):
+        if self.pending is None:
+            return
+        self.pending -= 1
+        if self.pending == 0:
+            ws_broadcast_seconds.observe(time.perf_counter() - self.created)
+
+    def encode(self, protocol: str) -> str | bytes:
+        encoded = self.encoded.get(protocol)
+        if encoded is None:
+            if protocol == "msgpack":
+                encoded = msgpack.packb(self.message)
+            else:
+                encoded = orjson.dumps(
+                    self.message, option=orjson.OPT_NON_STR_KEYS
+                ).decode()
+            self.encoded[protocol] = encoded
+        return encoded
+
+
+class Connection:
+    """A subscribed socket with a bounded outbound queue and its own sender.
+
+    Broadcasting only appends to the queue, a slow client therefore delays
+    nobody but itself. When the queue is full the slow consumer policy
+    decides what to give up: `drop_oldest` discards the oldest frame,
+    `coalesce` replaces a queued frame with the same key (falling back to
+    dropping the oldest) and `disconnect` closes the socket.
+
+    `on_close` runs as soon as the connection gives up, whether the policy,
+    a failed send or the client ended it, so nothing is queued for it after.
+    """
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        mode: str,
+        protocol: str,
+        max_queue: int,
+        policy: str,
+        send_timeout_ms: int,
+        on_close: Callable[[], Any],
+    ):
+        self.websocket = websocket
+        self.mode = mode
+        self.protocol = protocol
+        self.max_queue = max_queue
+        self.policy = policy
+        self.send_timeout = send_timeout_ms / 1000
+        self.queue: deque[tuple[Key, Frame]] = deque()
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.on_close = on_close
+        self.sender = asyncio.create_task(self._send_loop())
+
+    def enqueue(self, frame: Frame, key: Key = None) -> bool:
+        """Queue a frame, returns False when the connection must be dropped."""
+        if self.closed:
+            return False
+        if len(self.queue) >= self.max_queue:
+            if self.policy == "disconnect":
+                ws_dropped_frames.labels("disconnect").inc()
+                return False
+            if self.policy == "coalesce" and key is not None:
+                kept: deque[tuple[Key, Frame]] = deque()
+                for item in self.queue:
+                    if item[0] != key:
+                        kept.append(item)
+                    else:
+                        ws_dropped_frames.labels("coalesce").inc()
+                        item[1].done()
+                self.queue = kept
+            if len(self.queue) >= self.max_queue:
+                ws_dropped_frames.labels("drop_oldest").inc()
+                self.queue.popleft()[1].done()
+        self.queue.append((key, frame))
+        self.ready.set()
+        return True
+
+    def discard(self) -> bool:
+        """Stop sending and give up the queued frames, False if already done."""
+        if self.closed:
+            return False
+        self.closed = True
+        if self.sender is not asyncio.current_task():
+            self.sender.cancel()
+        if self.queue:
+            ws_dropped_frames.labels("closed").inc(len(self.queue))
+            for _, frame in self.queue:
+                frame.done()
+            self.queue.clear()
+        self.on_close()
+        return True
+
+    async def close(self, code: int = status.WS_1000_NORMAL_CLOSURE):
+        if self.discard():
+            await asyncio.wait([self.sender])
+            await self.close_socket(code)
+
+    async def close_socket(self, code: int):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+    async def _send_loop(self):
+        try:
+            while True:
+                await self.ready.wait()
+                while self.queue:
+                    _, frame = self.queue.popleft()
+                    data = frame.encode(self.protocol)
+                    if isinstance(data, bytes):
+                        sending = self.websocket.send_bytes(data)
+                    else:
+                        sending = self.websocket.send_text(data)
+                    # Unlike wait_for on 3.11, timeout() never swallows the
+                    # cancellation of a closing connection.
+                    try:
+                        async with asyncio.timeout(self.send_timeout):
+                            await sending
+                    finally:
+                        frame.done()
+                self.ready.clear()
+        except Exception as error:
+            # The client is gone or too slow to take a single frame.
+            timed_out = isinstance(error, asyncio.TimeoutError)
+            ws_send_failures.labels("timeout" if timed_out else "error").inc()
+            if self.discard():
+                asyncio.create_task(self.close_socket(status.WS_1011_INTERNAL_ERROR))
+
+
+class HotPolls:
+    """Polls that sent the most frames to their subscribers, for Prometheus.
+
+    Frames are counted per poll in windows of `window_seconds` and only the
+    `top_k` polls of the last complete window are exported, which bounds the
+    number of series whatever the number of polls.
+    """
+
+    def __init__(self, top_k: int, window_seconds: float):
+        self.top_k = top_k
+        self.window = window_seconds
+        self.started = time.monotonic()
+        self.current: dict[int, int] = {}
+        self.previous: dict[int, int] = {}
+
+    def record(self, poll_id: int, frames: int):
+        self._roll()
+        self.current[poll_id] = self.current.get(poll_id, 0) + frames
+
+    def top(self) -> list[tuple[int, int]]:
+        self._roll()
+        return heapq.nlargest(self.top_k, self.previous.items(), key=itemgetter(1))
+
+    def collect(self):
+        family = GaugeMetricFamily(
+            "ws_hot_poll_frames",
+            "Frames sent to the subscribers of the busiest polls in the last "
+            "complete window",
+            labels=["poll_id"],
+        )
+        for poll_id, frames in self.top():
+            family.add_metric([str(poll_id)], frames)
+        yield family
+
+    def _roll(self):
+        elapsed = time.monotonic() - self.started
+        if elapsed < self.window:
+            return
+        # A window without any broadcast leaves nothing to report.
+        self.previous = self.current if elapsed < 2 * self.window else {}
+        self.current = {}
+        self.started += elapsed - elapsed % self.window
 
 
 class WebSocketsManager:
-    def __init__(self):
-        self.active_polls: dict[int, set[WebSocket]] = {}
+    """Tracks the subscribers of every poll.
+
+    Subscribers in `events` mode receive one frame per vote. Subscribers in
+    `deltas` mode instead receive, once per tick, a single frame with the
+    latest count of every option that changed and a per-poll sequence
+    number, so a burst of votes costs one frame per subscriber and tick.
+
+    Broadcasts and counts go through the backplane, which delivers them back
+    to `deliver` in every process that has subscribers.
+    """
+
+    def __init__(self, tick_ms: int, backplane: InProcessBackplane | PostgresBackplane):
+        self.tick = tick_ms / 1000
+        self.backplane = backplane
+        self.active_polls: dict[int, dict[WebSocket, Connection]] = {}
+        self.delta_subscribers: dict[int, int] = {}
+        self.pending_counts: dict[int, dict[int, int]] = {}
+        self.sequences: dict[int, int] = {}
+        self.connections = 0
+        self.hot_polls = HotPolls(
+            settings.ws_hot_polls_top_k, settings.ws_hot_polls_window_seconds
+        )
+        self._ticker: asyncio.Task | None = None
+        ws_connections.set_function(lambda: self.connections)
+        ws_subscribed_polls.set_function(lambda: len(self.active_polls))
+
+    async def start(self):
+        await self.backplane.start(self.deliver)
+        self._ticker = asyncio.create_task(self._tick_loop())
+
+    async def stop(self):
+        if self._ticker is not None:
+            self._ticker.cancel()
+            self._ticker = None
+        await self.backplane.stop()
+        connections = [
+            connection
+            for subscribers in self.active_polls.values()
+            for connection in subscribers.values()
+        ]
+        # Closing waits for the senders and removes each connection, the
+        # registries are cleared anyway.
+        await asyncio.gather(
+            *(connection.close(status.WS_1001_GOING_AWAY) for connection in connections)
+        )
+        self.active_polls.clear()
+        self.delta_subscribers.clear()
+        self.pending_counts.clear()
+        self.sequences.clear()
+        self.connections = 0
 
-    async def connect(self, poll_id: int, websocket: WebSocket):
+    async def connect(
+        self,
+        poll_id: int,
+        websocket: WebSocket,
+        mode: str = "events",
+        protocol: str = "json",
+    ):
         if poll_id not in self.active_polls:
-            self.active_polls[poll_id] = set()
-        self.active_polls[poll_id].add(websocket)
+            self.active_polls[poll_id] = {}
+        self.active_polls[poll_id][websocket] = Connection(
+            websocket,
+            mode,
+            protocol,
+            settings.ws_queue_size,
+            settings.ws_slow_consumer_policy,
+            settings.ws_send_timeout_ms,
+            lambda: self._remove(poll_id, websocket),
+        )
+        self.connections += 1
+        if mode == "deltas":
+            self.delta_subscribers[poll_id] = self.delta_subscribers.get(poll_id, 0) + 1
 
     async def disconnect(self, poll_id: int, websocket: WebSocket):
-        self.active_polls[poll_id].remove(websocket)
-        if len(self.active_polls[poll_id]) == 0:
-            del self.active_polls[poll_id]
+        connection = self.active_polls.get(poll_id, {}).get(websocket)
+        if connection is not None:
+            await connection.close()
+
+    async def send(self, poll_id: int, websocket: WebSocket, message: Any):
+        connection = self.active_polls.get(poll_id, {}).get(websocket)
+        if connection is not None:
+            self._enqueue(poll_id, connection, Frame(message), None)
+
+    async def broadcast(self, poll_id: int, message: Any, key: Key = None):
+        self.backplane.publish({"p": poll_id, "t": "event", "k": key, "m": message})
+
+    def record_counts(self, poll_id: int, counts: dict[int, int]):
+        """Queue option counts for the next delta frame of the poll."""
+        self.backplane.publish({"p": poll_id, "t": "counts", "c": counts})
+
+    def deliver(self, envelope: Envelope):
+        poll_id = envelope["p"]
+        if poll_id not in self.active_polls:
+            return
+        if envelope["t"] == "event":
+            self._fan_out(poll_id, Frame(envelope["m"]), envelope["k"], "events")
+        elif envelope["t"] == "counts":
+            if poll_id in self.delta_subscribers:
+                # Option ids come back as strings after a trip through JSON.
+                counts = {int(key): value for key, value in envelope["c"].items()}
+                self.pending_counts.setdefault(poll_id, {}).update(counts)
+        elif envelope["t"] == "resync":
+            frame = Frame({"event": "resync", "data": {"poll_id": poll_id}})
+            self._fan_out(poll_id, frame, None, "events")
+            self._fan_out(poll_id, frame, None, "deltas")
 
-    async def broadcast(self, poll_id: int, message: Any):
-        message = json.dumps(message)
-        for websocket in self.active_polls[poll_id]:
-            await websocket.send_text(message)
+    def sequence(self, poll_id: int) -> int:
+        return self.sequences.get(poll_id, 0)
+
+    def flush_counts(self):
+        pending, self.pending_counts = self.pending_counts, {}
+        for poll_id, counts in pending.items():
+            sequence = self.sequences[poll_id] = self.sequence(poll_id) + 1
+            frame = Frame({"event": "counts", "seq": sequence, "data": counts})
+            self._fan_out(poll_id, frame, None, "deltas")
+
+    async def _tick_loop(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            self.flush_counts()
+
+    def _fan_out(self, poll_id: int, frame: Frame, key: Key, mode: str):
+        connections = self.active_polls.get(poll_id, {})
+        queued = 0
+        for connection in list(connections.values()):
+            if connection.mode == mode and self._enqueue(
+                poll_id, connection, frame, key
+            ):
+                queued += 1
+        frame.broadcast(queued)
+        if queued:
+            self.hot_polls.record(poll_id, queued)
+
+    def _enqueue(
+        self, poll_id: int, connection: Connection, frame: Frame, key: Key
+    ) -> bool:
+        if connection.enqueue(frame, key):
+            return True
+        # Removes the connection right away, closing the socket may block on
+        # the slow client so it is kept off this path.
+        if connection.discard():
+            asyncio.create_task(connection.close_socket(status.WS_1013_TRY_AGAIN_LATER))
+        return False
+
+    def _remove(self, poll_id: int, websocket: WebSocket) -> Connection | None:
+        connections = self.active_polls.get(poll_id)
+        if connections is None or websocket not in connections:
+            return None
+        connection = connections.pop(websocket)
+        self.connections -= 1
+        if len(connections) == 0:
+            del self.active_polls[poll_id]
+        if connection.mode == "deltas":
+            self.delta_subscribers[poll_id] -= 1
+            if self.delta_subscribers[poll_id] == 0:
+                del self.delta_subscribers[poll_id]
+                self.pending_counts.pop(poll_id, None)
+                self.sequences.pop(poll_id, None)
+        return connection
 
 
-ws_manager = WebSocketsManager()
+ws_manager = WebSocketsManager(settings.ws_delta_tick_ms, create_backplane())
+REGISTRY.register(ws_manager.hot_polls)
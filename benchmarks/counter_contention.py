@@ -0,0 +1,117 @@
+"""Compare lock contention of the vote counter modes on the real vote path.
+
+Every worker votes for the same option through `app.voting.cast_vote`, each
+vote by another user in its own transaction, then withdraws the votes with
+`withdraw_vote`. The script reports throughput and latency percentiles of
+both phases for each counter mode, the withdrawals leave the counters where
+they started.
+
+Usage: python -m benchmarks.counter_contention --workers 12 --votes 200
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from sqlalchemy import delete, insert
+
+from app.config import settings
+from app.counters import vote_counter_buffer
+from app.db import AsyncSessionLocal, async_engine, init_db
+from app.schemas import Option, OptionVoteSlot, Poll, User, Vote, VoteRollup
+from app.versions import poll_version_bumper
+from app.voting import cast_vote, withdraw_vote
+
+MODES = ("direct", "striped", "buffered")
+
+
+async def worker(
+    action, user_ids: list[int], poll_id: int, option_id: int, latencies: list[float]
+):
+    async with AsyncSessionLocal() as session:
+        for user_id in user_ids:
+            started = time.perf_counter()
+            outcome = await action(session, user_id, poll_id, option_id)
+            if outcome.vote_id is None:
+                raise RuntimeError(f"{action.__name__} did not apply for {user_id}")
+            latencies.append(time.perf_counter() - started)
+
+
+async def run(name: str, action, users: list[list[int]], poll_id, option_id):
+    latencies: list[float] = []
+    started = time.perf_counter()
+    await asyncio.gather(
+        *(worker(action, ids, poll_id, option_id, latencies) for ids in users)
+    )
+    elapsed = time.perf_counter() - started
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(
+        f"{name:>17}: {len(latencies) / elapsed:10.1f} votes/s"
+        f"  p50 {quantiles[49] * 1000:7.2f} ms"
+        f"  p95 {quantiles[94] * 1000:7.2f} ms"
+        f"  p99 {quantiles[98] * 1000:7.2f} ms"
+    )
+
+
+async def main(args):
+    await init_db()
+    stamp = time.time_ns()
+    async with AsyncSessionLocal() as session:
+        owner = User(
+            name="benchmark",
+            email=f"benchmark-{stamp}@example.com",
+            hashed_password="",
+        )
+        poll = Poll(title="benchmark", description="", user=owner)
+        option = Option(title="hot", description="", poll=poll, votes_count=0)
+        session.add(option)
+        await session.flush()
+        voter_ids = list(
+            await session.scalars(
+                insert(User).returning(User.id),
+                [
+                    {
+                        "name": f"voter {index}",
+                        "email": f"benchmark-{stamp}-{index}@example.com",
+                        "hashed_password": "",
+                    }
+                    for index in range(args.workers * args.votes)
+                ],
+            )
+        )
+        await session.commit()
+        poll_id, option_id = poll.id, option.id
+    users = [voter_ids[index :: args.workers] for index in range(args.workers)]
+    try:
+        for mode in args.modes:
+            settings.vote_counter_mode = mode
+            await run(f"{mode} vote", cast_vote, users, poll_id, option_id)
+            await run(f"{mode} withdraw", withdraw_vote, users, poll_id, option_id)
+            # What the background tasks would do after the run.
+            await vote_counter_buffer.flush()
+            await poll_version_bumper.flush()
+    finally:
+        async with AsyncSessionLocal() as session:
+            await session.execute(delete(Vote).where(Vote.poll_id == poll_id))
+            await session.execute(
+                delete(VoteRollup).where(VoteRollup.poll_id == poll_id)
+            )
+            await session.execute(
+                delete(OptionVoteSlot).where(OptionVoteSlot.option_id == option_id)
+            )
+            await session.execute(delete(Option).where(Option.poll_id == poll_id))
+            await session.execute(delete(Poll).where(Poll.id == poll_id))
+            await session.execute(
+                delete(User).where(User.id.in_([owner.id, *voter_ids]))
+            )
+            await session.commit()
+        await poll_version_bumper.runner.release()
+        await async_engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=12)
+    parser.add_argument("--votes", type=int, default=100)
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=MODES)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,491 @@
+"""Load-test the vote and WebSocket paths of the app running in-process.
+
+The app is driven through its ASGI interface, lifespan included, against
+the database configured in the environment. After registering `--users`
+users and creating `--polls` polls, each with `--subscribers` WebSocket
+subscribers, `--concurrency` workers run `--requests` operations drawn
+from `--mix`. Votes go to the first `--hot-options` options of a poll
+`--hot-share` of the time.
+
+The report has the throughput and latency percentiles of every operation,
+how long vote frames take to reach the subscribers, counted from the
+moment the vote request is sent, and the SQL statements run per request
+of every route. It is printed as JSON, written to `--output` if given,
+and compared against `--baseline` if given; the exit status is 1 when a
+figure regressed by more than `--tolerance`.
+
+Usage: python -m benchmarks.load_test --requests 5000 --output report.json
+       python -m benchmarks.load_test --baseline report.json
+"""
+import argparse
+import asyncio
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+from collections import defaultdict
+from typing import Any
+from urllib.parse import urlsplit
+
+import orjson
+from prometheus_client import REGISTRY
+from sqlalchemy import select
+
+from app.config import settings
+from app.db import AsyncSessionLocal
+from app.main import app
+from app.schemas import User
+
+PASSWORD = "benchmark"
+
+# Direction in which each figure of the report gets worse.
+LOWER_IS_WORSE = {"throughput"}
+HIGHER_IS_WORSE = {"p50_ms", "p95_ms", "p99_ms", "errors", "queries_per_request"}
+
+
+class ASGIClient:
+    """Minimal HTTP and WebSocket client calling an ASGI app directly."""
+
+    def __init__(self, asgi_app):
+        self.app = asgi_app
+
+    def _scope(self, kind: str, path: str, headers: dict[str, str]) -> dict:
+        url = urlsplit(path)
+        return {
+            "type": kind,
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "scheme": "http" if kind == "http" else "ws",
+            "path": url.path,
+            "raw_path": url.path.encode(),
+            "query_string": url.query.encode(),
+            "root_path": "",
+            "headers": [
+                (name.lower().encode(), value.encode())
+                for name, value in headers.items()
+            ],
+            "client": ("127.0.0.1", 50000),
+            "server": ("testserver", 80),
+        }
+
+    async def request(
+        self, method: str, path: str, body: Any = None, token: str | None = None
+    ) -> tuple[int, Any]:
+        headers = {"host": "testserver"}
+        if token is not None:
+            headers["authorization"] = f"Bearer {token}"
+        content = b""
+        if body is not None:
+            content = orjson.dumps(body)
+            headers["content-type"] = "application/json"
+        scope = self._scope("http", path, headers)
+        scope["method"] = method
+        response: dict[str, Any] = {"status": 500, "body": bytearray()}
+        done = asyncio.Event()
+        sent = False
+
+        async def receive():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {"type": "http.request", "body": content, "more_body": False}
+            await done.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                response["body"] += message.get("body", b"")
+                if not message.get("more_body", False):
+                    done.set()
+
+        await self.app(scope, receive, send)
+        done.set()
+        data = orjson.loads(response["body"]) if response["body"] else None
+        return response["status"], data
+
+    async def subscribe(self, path: str, token: str) -> "Subscriber":
+        subscriber = Subscriber()
+        scope = self._scope(
+            "websocket",
+            path,
+            {"host": "testserver", "authorization": f"Bearer {token}"},
+        )
+        scope["subprotocols"] = []
+        subscriber.task = asyncio.create_task(
+            self.app(scope, subscriber.receive, subscriber.send)
+        )
+        await subscriber.accepted.wait()
+        return subscriber
+
+
+class Subscriber:
+    """Keeps the frames of one WebSocket with the time they arrived."""
+
+    def __init__(self):
+        self.accepted = asyncio.Event()
+        self.closing = asyncio.Event()
+        self.connected = False
+        self.frames: list[tuple[float, str | bytes]] = []
+        self.task: asyncio.Task | None = None
+
+    async def receive(self):
+        if not self.connected:
+            self.connected = True
+            return {"type": "websocket.connect"}
+        await self.closing.wait()
+        return {"type": "websocket.disconnect", "code": 1000}
+
+    async def send(self, message):
+        if message["type"] == "websocket.send":
+            frame = message.get("text") or message.get("bytes")
+            self.frames.append((time.perf_counter(), frame))
+        elif message["type"] in ("websocket.accept", "websocket.close"):
+            self.accepted.set()
+
+    async def close(self):
+        self.closing.set()
+        if self.task is not None:
+            await self.task
+
+
+def percentiles(samples: list[float]) -> dict[str, float | None]:
+    if len(samples) < 2:
+        value = samples[0] * 1000 if samples else None
+        return {"p50_ms": value, "p95_ms": value, "p99_ms": value}
+    quantiles = statistics.quantiles(samples, n=100)
+    return {
+        "p50_ms": quantiles[49] * 1000,
+        "p95_ms": quantiles[94] * 1000,
+        "p99_ms": quantiles[98] * 1000,
+    }
+
+
+def summarize(
+    latencies: dict[str, list[float]], errors: dict[str, int]
+) -> dict[str, dict[str, Any]]:
+    return {
+        name: {"count": len(samples), "errors": errors[name], **percentiles(samples)}
+        for name, samples in sorted(latencies.items())
+    }
+
+
+def queries_per_route() -> dict[str, tuple[float, float]]:
+    """Statements and requests counted so far by the SQL stats middleware."""
+    totals: dict[str, list[float]] = defaultdict(lambda: [0.0, 0.0])
+    for metric in REGISTRY.collect():
+        if metric.name != "db_queries_per_request":
+            continue
+        for sample in metric.samples:
+            if sample.name.endswith("_sum"):
+                totals[sample.labels["route"]][0] = sample.value
+            elif sample.name.endswith("_count"):
+                totals[sample.labels["route"]][1] = sample.value
+    return {route: (total[0], total[1]) for route, total in totals.items()}
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.client = ASGIClient(app)
+        self.random = random.Random(args.seed)
+        self.run_id = time.time_ns()
+        self.tokens: list[str] = []
+        self.polls: list[tuple[int, list[int]]] = []
+        self.subscribers: list[Subscriber] = []
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.errors: dict[str, int] = defaultdict(int)
+        self.setup_latencies: dict[str, list[float]] = {}
+        self.setup_errors: dict[str, int] = {}
+        # Votes that can be withdrawn, and the (user, poll) pairs taken.
+        self.votes: list[tuple[int, int, int, int]] = []
+        self.taken: set[tuple[int, int]] = set()
+        # When the request behind each vote frame was sent.
+        self.sent_at: dict[tuple[str, int], float] = {}
+        self.operations = {
+            "login": self.login,
+            "create_poll": self.create_poll,
+            "get_poll": self.get_poll,
+            "vote": self.vote,
+            "unvote": self.unvote,
+        }
+
+    async def timed(
+        self, name: str, method: str, path: str, body: Any = None, token=None
+    ) -> tuple[int, Any, float]:
+        started = time.perf_counter()
+        status, data = await self.client.request(method, path, body, token)
+        self.latencies[name].append(time.perf_counter() - started)
+        if status >= 400:
+            self.errors[name] += 1
+        return status, data, started
+
+    def email(self, user: int) -> str:
+        return f"load-{self.run_id}-{user}@example.com"
+
+    async def register(self, user: int):
+        body = {"name": f"load {user}", "email": self.email(user), "password": PASSWORD}
+        status, data, _ = await self.timed("register", "POST", "/register", body)
+        if status != 201:
+            raise RuntimeError(f"Registering a user failed with {status}: {data}")
+        self.tokens[user] = data["access_token"]
+
+    async def login(self):
+        user = self.random.randrange(len(self.tokens))
+        body = {"email": self.email(user), "password": PASSWORD}
+        await self.timed("login", "POST", "/login", body)
+
+    async def create_poll(self):
+        user = self.random.randrange(len(self.tokens))
+        body = {
+            "title": f"load poll {len(self.polls)}",
+            "description": "",
+            "options": [
+                {"title": f"option {index}", "description": ""}
+                for index in range(self.args.options)
+            ],
+        }
+        status, data, _ = await self.timed(
+            "create_poll", "POST", "/polls", body, self.tokens[user]
+        )
+        if status == 201:
+            options = [option["id"] for option in data["options"]]
+            self.polls.append((data["id"], options))
+
+    async def get_poll(self):
+        poll_id, _ = self.random.choice(self.polls)
+        await self.timed("get_poll", "GET", f"/polls/{poll_id}")
+
+    async def vote(self):
+        for _ in range(10):
+            user = self.random.randrange(len(self.tokens))
+            poll_id, options = self.random.choice(self.polls)
+            if (user, poll_id) not in self.taken:
+                break
+        else:
+            # Everyone voted in the polls drawn, withdraw a vote instead.
+            return await self.unvote()
+        hot = options[: self.args.hot_options]
+        if self.random.random() < self.args.hot_share:
+            option_id = self.random.choice(hot)
+        else:
+            option_id = self.random.choice(options)
+        self.taken.add((user, poll_id))
+        status, data, started = await self.timed(
+            "vote",
+            "POST",
+            f"/polls/{poll_id}/options/{option_id}/vote",
+            token=self.tokens[user],
+        )
+        if status != 201:
+            self.taken.discard((user, poll_id))
+            return
+        self.votes.append((user, poll_id, option_id, data["id"]))
+        self.sent_at["vote", data["id"]] = started
+
+    async def unvote(self):
+        if not self.votes:
+            return await self.vote()
+        index = self.random.randrange(len(self.votes))
+        self.votes[index], self.votes[-1] = self.votes[-1], self.votes[index]
+        user, poll_id, option_id, vote_id = self.votes.pop()
+        status, _, started = await self.timed(
+            "unvote",
+            "DELETE",
+            f"/polls/{poll_id}/options/{option_id}/vote",
+            token=self.tokens[user],
+        )
+        if status == 204:
+            self.taken.discard((user, poll_id))
+            self.sent_at["delete", vote_id] = started
+
+    async def setup(self):
+        self.tokens = [""] * self.args.users
+        # Registering is bound by the password hashing workers, not the pool.
+        await self.gather(
+            (self.register(user) for user in range(self.args.users)),
+            settings.password_hashing_workers,
+        )
+        await self.gather(
+            (self.create_poll() for _ in range(self.args.polls)),
+            self.args.concurrency,
+        )
+        for poll_id, _ in self.polls:
+            for index in range(self.args.subscribers):
+                token = self.tokens[index % len(self.tokens)]
+                self.subscribers.append(
+                    await self.client.subscribe(f"/polls/{poll_id}", token)
+                )
+
+    async def gather(self, operations, limit: int):
+        semaphore = asyncio.Semaphore(limit)
+
+        async def bounded(operation):
+            async with semaphore:
+                await operation
+
+        await asyncio.gather(*(bounded(operation) for operation in operations))
+
+    async def run(self) -> float:
+        self.setup_latencies, self.latencies = self.latencies, defaultdict(list)
+        self.setup_errors, self.errors = self.errors, defaultdict(int)
+        names, weights = zip(*self.args.mix.items())
+        remaining = self.args.requests
+
+        async def worker():
+            nonlocal remaining
+            while remaining > 0:
+                remaining -= 1
+                name = self.random.choices(names, weights)[0]
+                await self.operations[name]()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(self.args.concurrency)))
+        elapsed = time.perf_counter() - started
+        # Let the last broadcasts reach the subscribers.
+        await asyncio.sleep(0.5)
+        return elapsed
+
+    async def teardown(self):
+        for subscriber in self.subscribers:
+            await subscriber.close()
+        async with AsyncSessionLocal() as session:
+            users = await session.scalars(
+                select(User).where(User.email.like(f"load-{self.run_id}-%"))
+            )
+            for user in users.all():
+                await session.delete(user)
+            await session.commit()
+
+    def broadcast_lag(self) -> dict[str, Any]:
+        lags: list[float] = []
+        for subscriber in self.subscribers:
+            for received, frame in subscriber.frames:
+                message = orjson.loads(frame)
+                if message["event"] not in ("vote", "delete"):
+                    continue
+                vote_id = message["data"]["vote"]["id"]
+                sent = self.sent_at.get((message["event"], vote_id))
+                if sent is not None:
+                    lags.append(received - sent)
+        return {"frames": len(lags), **percentiles(lags)}
+
+    def report(self, elapsed: float, queries: dict) -> dict[str, Any]:
+        operations = summarize(self.latencies, self.errors)
+        for name, operation in operations.items():
+            operation["throughput"] = operation["count"] / elapsed
+        run_count = sum(operation["count"] for operation in operations.values())
+        return {
+            "config": {
+                **vars(self.args),
+                "vote_counter_mode": settings.vote_counter_mode,
+                "ws_backplane": settings.ws_backplane,
+                "db_pool_size": settings.db_pool_size,
+            },
+            "python": platform.python_version(),
+            "setup": summarize(self.setup_latencies, self.setup_errors),
+            "elapsed_seconds": elapsed,
+            "throughput": run_count / elapsed,
+            "operations": operations,
+            "broadcast_lag": self.broadcast_lag(),
+            "queries_per_request": queries,
+        }
+
+
+def parse_mix(value: str) -> dict[str, float]:
+    mix = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        mix[name.strip()] = float(weight)
+    return mix
+
+
+def figures(report: dict[str, Any]) -> dict[str, float]:
+    """Flatten the comparable figures of a report into dotted names."""
+    flat = {"throughput": report["throughput"]}
+    for phase in ("setup", "operations"):
+        for name, operation in report[phase].items():
+            for key, value in operation.items():
+                if key != "count" and value is not None:
+                    flat[f"{phase}.{name}.{key}"] = value
+    for key, value in report["broadcast_lag"].items():
+        if key != "frames" and value is not None:
+            flat[f"broadcast_lag.{key}"] = value
+    for route, value in report["queries_per_request"].items():
+        flat[f"queries_per_request.{route}.queries_per_request"] = value
+    return flat
+
+
+def compare(report: dict[str, Any], baseline: dict[str, Any], tolerance: float):
+    """Print the figures that moved, returns True when any of them regressed."""
+    current, previous = figures(report), figures(baseline)
+    regressed = False
+    for name in sorted(current.keys() & previous.keys()):
+        before, after = previous[name], current[name]
+        metric = name.rsplit(".", 1)[-1]
+        change = (after - before) / before if before else (1.0 if after else 0.0)
+        if metric in LOWER_IS_WORSE:
+            worse = change < -tolerance
+        elif metric in HIGHER_IS_WORSE:
+            worse = change > tolerance
+        else:
+            continue
+        regressed = regressed or worse
+        print(
+            f"{'REGRESSED' if worse else 'ok':>9}  {name:<60}"
+            f" {before:12.2f} -> {after:12.2f} ({change:+.1%})",
+            file=sys.stderr,
+        )
+    return regressed
+
+
+async def main(args) -> int:
+    load_test = LoadTest(args)
+    async with app.router.lifespan_context(app):
+        try:
+            await load_test.setup()
+            before = queries_per_route()
+            elapsed = await load_test.run()
+            after = queries_per_route()
+        finally:
+            await load_test.teardown()
+    queries = {}
+    for route, (statements, requests) in after.items():
+        statements -= before.get(route, (0.0, 0.0))[0]
+        requests -= before.get(route, (0.0, 0.0))[1]
+        if requests:
+            queries[route] = statements / requests
+    report = load_test.report(elapsed, queries)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            return int(compare(report, json.load(baseline), args.tolerance))
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--polls", type=int, default=10)
+    parser.add_argument("--options", type=int, default=5)
+    parser.add_argument("--subscribers", type=int, default=10)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument(
+        "--mix",
+        type=parse_mix,
+        default="vote=60,unvote=25,get_poll=10,login=3,create_poll=2",
+    )
+    parser.add_argument("--hot-options", type=int, default=1)
+    parser.add_argument("--hot-share", type=float, default=0.8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output")
+    parser.add_argument("--baseline")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    sys.exit(asyncio.run(main(parser.parse_args())))
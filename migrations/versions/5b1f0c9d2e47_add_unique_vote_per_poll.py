@@ -0,0 +1,45 @@
+"""Add unique vote per poll
+
+Revision ID: 5b1f0c9d2e47
+Revises: e777825d24a3
+Create Date: 2026-10-18 10:12:31.204518
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "5b1f0c9d2e47"
+down_revision: Union[str, None] = "e777825d24a3"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Keep the earliest vote of every user in a poll and recount the options,
+    # the constraint cannot be created while duplicates exist.
+    op.execute(
+        """
+        DELETE FROM votes
+        USING votes AS earlier
+        WHERE votes.user_id = earlier.user_id
+          AND votes.poll_id = earlier.poll_id
+          AND votes.id > earlier.id
+        """
+    )
+    op.execute(
+        """
+        UPDATE options
+        SET votes_count = (
+            SELECT count(*) FROM votes WHERE votes.option_id = options.id
+        )
+        """
+    )
+    op.create_unique_constraint(
+        "votes_user_id_poll_id_key", "votes", ["user_id", "poll_id"]
+    )
+
+
+def downgrade() -> None:
+    op.drop_constraint("votes_user_id_poll_id_key", "votes", type_="unique")
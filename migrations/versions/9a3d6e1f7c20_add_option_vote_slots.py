@@ -0,0 +1,45 @@
+"""Add option vote slots
+
+Revision ID: 9a3d6e1f7c20
+Revises: 5b1f0c9d2e47
+Create Date: 2026-10-18 11:02:47.581903
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "9a3d6e1f7c20"
+down_revision: Union[str, None] = "5b1f0c9d2e47"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "option_vote_slots",
+        sa.Column("option_id", sa.Integer(), nullable=False),
+        sa.Column("slot", sa.Integer(), nullable=False),
+        sa.Column("votes_count", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(["option_id"], ["options.id"]),
+        sa.PrimaryKeyConstraint("option_id", "slot"),
+    )
+
+
+def downgrade() -> None:
+    # Fold the striped increments back into the single-row counter.
+    op.execute(
+        """
+        UPDATE options
+        SET votes_count = options.votes_count + slots.votes_count
+        FROM (
+            SELECT option_id, sum(votes_count) AS votes_count
+            FROM option_vote_slots
+            GROUP BY option_id
+        ) AS slots
+        WHERE options.id = slots.option_id
+        """
+    )
+    op.drop_table("option_vote_slots")
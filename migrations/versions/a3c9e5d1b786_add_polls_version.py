@@ -0,0 +1,28 @@
+"""Add polls version
+
+Revision ID: a3c9e5d1b786
+Revises: f1a7c3e9b254
+Create Date: 2026-10-18 13:41:17.264903
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "a3c9e5d1b786"
+down_revision: Union[str, None] = "f1a7c3e9b254"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "polls",
+        sa.Column("version", sa.Integer(), server_default="0", nullable=False),
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("polls", "version")
@@ -0,0 +1,24 @@
+"""Add polls user_id index
+
+Revision ID: c4e8a2b7d913
+Revises: 9a3d6e1f7c20
+Create Date: 2026-10-18 12:20:05.733146
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "c4e8a2b7d913"
+down_revision: Union[str, None] = "9a3d6e1f7c20"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index("ix_polls_user_id_id", "polls", ["user_id", "id"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_polls_user_id_id", table_name="polls")
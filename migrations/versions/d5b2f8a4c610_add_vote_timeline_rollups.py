@@ -0,0 +1,60 @@
+"""Add vote timeline rollups
+
+Revision ID: d5b2f8a4c610
+Revises: a3c9e5d1b786
+Create Date: 2026-10-18 14:22:53.518204
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "d5b2f8a4c610"
+down_revision: Union[str, None] = "a3c9e5d1b786"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Existing votes have no cast time, they are all dated to the migration.
+    op.add_column(
+        "votes",
+        sa.Column(
+            "created_at",
+            sa.DateTime(timezone=True),
+            server_default=sa.text("now()"),
+            nullable=False,
+        ),
+    )
+    # The rollups are re-counted from the recent votes.
+    op.create_index("ix_votes_created_at", "votes", ["created_at"])
+    op.create_table(
+        "vote_rollups",
+        sa.Column("poll_id", sa.Integer(), nullable=False),
+        sa.Column("option_id", sa.Integer(), nullable=False),
+        sa.Column("bucket", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("votes_count", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(["poll_id"], ["polls.id"]),
+        sa.ForeignKeyConstraint(["option_id"], ["options.id"]),
+        sa.PrimaryKeyConstraint("poll_id", "option_id", "bucket"),
+    )
+    op.create_index("ix_vote_rollups_option_id", "vote_rollups", ["option_id"])
+    op.create_index("ix_vote_rollups_bucket", "vote_rollups", ["bucket"])
+    op.execute(
+        """
+        INSERT INTO vote_rollups (poll_id, option_id, bucket, votes_count)
+        SELECT poll_id, option_id, date_trunc('minute', created_at), count(*)
+        FROM votes
+        GROUP BY 1, 2, 3
+        """
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_vote_rollups_bucket", table_name="vote_rollups")
+    op.drop_index("ix_vote_rollups_option_id", table_name="vote_rollups")
+    op.drop_table("vote_rollups")
+    op.drop_index("ix_votes_created_at", table_name="votes")
+    op.drop_column("votes", "created_at")
@@ -0,0 +1,30 @@
+"""Add lookup indexes
+
+Revision ID: f1a7c3e9b254
+Revises: c4e8a2b7d913
+Create Date: 2026-10-18 12:58:41.092317
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "f1a7c3e9b254"
+down_revision: Union[str, None] = "c4e8a2b7d913"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # votes(user_id, poll_id, option_id) lookups are already served by the
+    # votes_user_id_poll_id_key unique index.
+    op.create_index("ix_options_poll_id", "options", ["poll_id"])
+    op.create_index("ix_votes_poll_id_id", "votes", ["poll_id", "id"])
+    op.create_index("ix_votes_option_id", "votes", ["option_id"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_votes_option_id", table_name="votes")
+    op.drop_index("ix_votes_poll_id_id", table_name="votes")
+    op.drop_index("ix_options_poll_id", table_name="options")
@@ -0,0 +1,201 @@
+"""Fail when a hot query of the API plans a sequential scan of a large table.
+
+Seeds the configured database with synthetic rows inside a transaction,
+analyzes the tables, runs EXPLAIN on the statements of the hot paths, as
+built by the routers and background tasks themselves, and on a lookup by
+every column the API filters on, then rolls everything back. Any sequential
+scan of a table holding more rows than --max-seq-scan-rows is reported and
+makes the script exit with a non-zero status.
+
+Usage: python -m scripts.check_query_plans --votes 200000
+"""
+import argparse
+import sys
+from datetime import datetime, timezone
+
+from sqlalchemy import select, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine import Connection
+
+from app.counters import slot_sums
+from app.db import Base, engine
+from app.reconciler import corrections
+from app.rollups import vote_rollup_aggregator
+from app.routers.polls import user_polls_query
+from app.routers.votes import export_query, timeline_query
+from app.schemas import Option, OptionVoteSlot, Poll, User, Vote, VoteRollup
+from app.versions import bump_versions
+from app.voting import batch_vote_statement, unvote_statement, vote_statement
+
+
+def seed(connection: Connection, args) -> dict[str, int]:
+    """Insert synthetic rows with explicit ids above the existing ones."""
+    bases = {
+        table: connection.scalar(text(f"SELECT coalesce(max(id), 0) FROM {table}"))
+        for table in ("users", "polls", "options", "votes")
+    }
+    params = {**{f"{table}_base": base for table, base in bases.items()}, **vars(args)}
+    connection.execute(
+        text(
+            "INSERT INTO users (id, name, email, hashed_password) "
+            "SELECT :users_base + 1 + i, 'user ' || i, "
+            "'plan-check-' || i || '@example.com', '' "
+            "FROM generate_series(0, :users - 1) AS i"
+        ),
+        params,
+    )
+    connection.execute(
+        text(
+            "INSERT INTO polls (id, title, description, user_id) "
+            "SELECT :polls_base + 1 + i, 'poll ' || i, '', "
+            ":users_base + 1 + i % :users "
+            "FROM generate_series(0, :polls - 1) AS i"
+        ),
+        params,
+    )
+    # Option i belongs to poll i % polls.
+    connection.execute(
+        text(
+            "INSERT INTO options (id, title, description, poll_id, votes_count) "
+            "SELECT :options_base + 1 + i, 'option ' || i, '', "
+            ":polls_base + 1 + i % :polls, 0 "
+            "FROM generate_series(0, :options - 1) AS i"
+        ),
+        params,
+    )
+    # Vote i is cast by user i % users in poll i / users, which keeps
+    # (user_id, poll_id) unique as long as votes <= users * polls.
+    connection.execute(
+        text(
+            "INSERT INTO votes (id, user_id, poll_id, option_id) "
+            "SELECT :votes_base + 1 + i, :users_base + 1 + i % :users, "
+            ":polls_base + 1 + (i / :users) % :polls, "
+            ":options_base + 1 + (i / :users) % :polls "
+            "+ :polls * (i % (:options / :polls)) "
+            "FROM generate_series(0, :votes - 1) AS i"
+        ),
+        params,
+    )
+    # One rollup per option, spread over the last hour.
+    connection.execute(
+        text(
+            "INSERT INTO vote_rollups (poll_id, option_id, bucket, votes_count) "
+            "SELECT poll_id, id, "
+            "date_trunc('minute', now()) - id % 60 * interval '1 minute', 1 "
+            "FROM options WHERE id > :options_base"
+        ),
+        params,
+    )
+    for table in (
+        "users",
+        "polls",
+        "options",
+        "option_vote_slots",
+        "votes",
+        "vote_rollups",
+    ):
+        connection.execute(text(f"ANALYZE {table}"))
+    return bases
+
+
+def lookups(bases: dict[str, int]):
+    """Columns the API looks rows up by, with a value to look up."""
+    user_id = bases["users"] + 1
+    poll_id = bases["polls"] + 1
+    option_id = bases["options"] + 1
+    return [
+        (User.id, user_id),
+        (User.email, "plan-check-1@example.com"),
+        (Poll.id, poll_id),
+        (Option.id, option_id),
+        (Option.poll_id, poll_id),
+        (OptionVoteSlot.option_id, option_id),
+        (Vote.poll_id, poll_id),
+        (Vote.option_id, option_id),
+        (Vote.user_id, user_id),
+        (VoteRollup.poll_id, poll_id),
+        (VoteRollup.option_id, option_id),
+    ]
+
+
+def hot_queries(bases: dict[str, int]):
+    """The statements of the hot paths, built by the code that runs them."""
+    user_id = bases["users"] + 1
+    poll_id = bases["polls"] + 1
+    option_id = bases["options"] + 1
+    queries = {
+        f"lookup by {column}": select(column.class_).where(column == value)
+        for column, value in lookups(bases)
+    }
+    return {
+        **queries,
+        "get_polls page": user_polls_query(user_id, poll_id, 50),
+        "striped totals": slot_sums([option_id]),
+        "vote": vote_statement(user_id, poll_id, option_id),
+        "delete_vote": unvote_statement(user_id, poll_id, option_id),
+        "batch vote": batch_vote_statement(user_id, [(poll_id, option_id)]),
+        "timeline": timeline_query(poll_id, "hour", None, None),
+        "export": export_query(poll_id),
+        "poll versions": bump_versions([poll_id]),
+        "reconcile": corrections([option_id]),
+        "recent rollups": vote_rollup_aggregator.recent(),
+        "withdrawn rollups": vote_rollup_aggregator.withdrawn(
+            {(poll_id, datetime.now(timezone.utc))}
+        ),
+    }
+
+
+def seq_scans(plan: dict):
+    if plan["Node Type"] == "Seq Scan":
+        yield plan["Relation Name"]
+    for child in plan.get("Plans", []):
+        yield from seq_scans(child)
+
+
+def check(connection: Connection, args) -> list[str]:
+    bases = seed(connection, args)
+    table_rows = {
+        table.name: connection.scalar(
+            text("SELECT reltuples FROM pg_class WHERE relname = :name"),
+            {"name": table.name},
+        )
+        for table in Base.metadata.sorted_tables
+    }
+    failures = []
+    for name, statement in hot_queries(bases).items():
+        sql = statement.compile(
+            dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}
+        )
+        plan = connection.scalar(text(f"EXPLAIN (FORMAT JSON) {sql}"))[0]["Plan"]
+        for table in seq_scans(plan):
+            if table_rows.get(table, 0) > args.max_seq_scan_rows:
+                failures.append(
+                    f"{name}: sequential scan on {table} "
+                    f"({table_rows[table]:.0f} rows)"
+                )
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--polls", type=int, default=20000)
+    parser.add_argument("--options", type=int, default=60000)
+    parser.add_argument("--votes", type=int, default=200000)
+    parser.add_argument("--max-seq-scan-rows", type=int, default=1000)
+    args = parser.parse_args()
+    Base.metadata.create_all(bind=engine)
+    with engine.connect() as connection:
+        try:
+            failures = check(connection, args)
+        finally:
+            connection.rollback()
+    for failure in failures:
+        print(failure)
+    if failures:
+        sys.exit(1)
+    print("No sequential scans on large tables")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+"""Generate a large synthetic dataset and load it with parallel COPY streams.
+
+Users, polls, options and votes are generated from --seed, so the same
+arguments always produce the same rows, whatever the number of streams.
+Polls belong mostly to a few power users (--owner-skew), the number of
+votes per poll follows a Zipf distribution (--poll-skew) so a few polls
+are hot, and within a poll the votes favour some options (--option-skew).
+Every user can log in with --password.
+
+Each table is split into --streams shards, generated and loaded with
+`COPY` by as many processes in parallel, parents before children. Ids
+are assigned above the existing ones, or from 1 with --truncate. Once
+loaded, `votes_count` and the vote rollups are recomputed from the votes,
+the id sequences are moved past the new rows and the tables analyzed.
+
+Load into a database no app is serving, the app caches polls and users.
+
+Usage: python -m scripts.generate_data --users 1000000 --polls 200000 \\
+       --votes 20000000 --streams 8
+"""
+import argparse
+import io
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from itertools import accumulate, islice
+from typing import Any, Iterator
+
+from sqlalchemy import text
+
+from app.db import engine
+from app.passwords import pwd_context
+
+NAMES = ("Alice", "Bob", "Carol", "Dave", "Erin", "Frank", "Grace", "Heidi")
+TOPICS = ("lunch", "the release date", "the offsite", "the logo", "the mascot")
+
+COLUMNS = {
+    "users": ("id", "name", "email", "hashed_password"),
+    "polls": ("id", "title", "description", "user_id", "version"),
+    "options": ("id", "title", "description", "poll_id", "votes_count"),
+    "votes": ("id", "user_id", "poll_id", "option_id", "created_at"),
+}
+
+
+def user_rows(context: dict[str, Any], start: int, stop: int) -> Iterator[str]:
+    base = context["bases"]["users"]
+    for index in range(start, stop):
+        user_id = base + 1 + index
+        yield (
+            f"{user_id}\t{NAMES[index % len(NAMES)]} {index}\t"
+            f"synthetic-{user_id}@example.com\t{context['hashed_password']}\n"
+        )
+
+
+def poll_rows(context: dict[str, Any], start: int, owners: list[int]):
+    bases = context["bases"]
+    for index, owner in enumerate(owners, start):
+        poll_id = bases["polls"] + 1 + index
+        topic = TOPICS[index % len(TOPICS)]
+        yield (
+            f"{poll_id}\tPoll {poll_id} about {topic}\t\t"
+            f"{bases['users'] + 1 + owner}\t0\n"
+        )
+
+
+def option_rows(context: dict[str, Any], start: int, counts: list[int], first: int):
+    option_id = context["bases"]["options"] + 1 + first
+    for index, count in enumerate(counts, start):
+        poll_id = context["bases"]["polls"] + 1 + index
+        for number in range(1, count + 1):
+            yield f"{option_id}\tOption {number}\t\t{poll_id}\t0\n"
+            option_id += 1
+
+
+def vote_rows(
+    context: dict[str, Any],
+    start: int,
+    counts: list[int],
+    voters: list[int],
+    first_option: int,
+    first_vote: int,
+):
+    bases = context["bases"]
+    option_id = bases["options"] + 1 + first_option
+    vote_id = bases["votes"] + 1 + first_vote
+    window = context["days"] * 86400
+    for index, (count, voter_count) in enumerate(zip(counts, voters), start):
+        poll_id = bases["polls"] + 1 + index
+        # Seeded per poll, so the votes do not depend on the shard boundaries.
+        rng = random.Random(context["seed"] * 1_000_003 + index)
+        options = list(range(option_id, option_id + count))
+        rng.shuffle(options)
+        weights = [rank ** -context["option_skew"] for rank in range(1, count + 1)]
+        users = rng.sample(range(context["users"]), voter_count)
+        chosen = rng.choices(options, weights, k=voter_count)
+        for user, chosen_option in zip(users, chosen):
+            created_at = context["now"] - timedelta(seconds=rng.random() * window)
+            yield (
+                f"{vote_id}\t{bases['users'] + 1 + user}\t{poll_id}\t"
+                f"{chosen_option}\t{created_at.isoformat()}\n"
+            )
+            vote_id += 1
+        option_id += count
+
+
+def copy_shard(table: str, rows_function, *args) -> int:
+    """Load one shard of a table through its own connection."""
+    columns = ", ".join(COLUMNS[table])
+    rows = rows_function(*args)
+    copied = 0
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        while batch := list(islice(rows, 50000)):
+            cursor.copy_expert(
+                f"COPY {table} ({columns}) FROM STDIN", io.StringIO("".join(batch))
+            )
+            copied += len(batch)
+        connection.commit()
+    finally:
+        connection.close()
+    return copied
+
+
+def shards(total: int, streams: int) -> list[tuple[int, int]]:
+    size = -(-total // streams)
+    return [(start, min(start + size, total)) for start in range(0, total, size)]
+
+
+def layout(args) -> dict[str, list[int]]:
+    """Owner, option count and vote count of every poll."""
+    rng = random.Random(args.seed)
+    owners = [
+        int(args.users * rng.random() ** args.owner_skew) for _ in range(args.polls)
+    ]
+    counts = [rng.randint(2, args.max_options) for _ in range(args.polls)]
+    ranks = list(range(1, args.polls + 1))
+    rng.shuffle(ranks)
+    weights = [rank ** -args.poll_skew for rank in ranks]
+    scale = args.votes / sum(weights)
+    # Rounded at random so the total stays close to --votes on long tails.
+    voters = [
+        min(args.users, int(weight * scale + rng.random())) for weight in weights
+    ]
+    return {"owners": owners, "counts": counts, "voters": voters}
+
+
+def prepare(args) -> dict[str, int]:
+    with engine.begin() as connection:
+        if args.truncate:
+            connection.execute(
+                text(
+                    "TRUNCATE users, polls, options, option_vote_slots, votes, "
+                    "vote_rollups RESTART IDENTITY"
+                )
+            )
+        return {
+            table: connection.scalar(text(f"SELECT coalesce(max(id), 0) FROM {table}"))
+            for table in COLUMNS
+        }
+
+
+def fix_up(bases: dict[str, int]):
+    """Bring counters, rollups and sequences in line with the loaded rows."""
+    with engine.begin() as connection:
+        connection.execute(
+            text(
+                "UPDATE options SET votes_count = counted.votes_count "
+                "FROM (SELECT option_id, count(*) AS votes_count FROM votes "
+                "WHERE id > :votes GROUP BY option_id) AS counted "
+                "WHERE options.id = counted.option_id"
+            ),
+            bases,
+        )
+        connection.execute(
+            text(
+                "INSERT INTO vote_rollups (poll_id, option_id, bucket, votes_count) "
+                "SELECT poll_id, option_id, date_trunc('minute', created_at), "
+                "count(*) FROM votes WHERE id > :votes GROUP BY 1, 2, 3"
+            ),
+            bases,
+        )
+        for table in COLUMNS:
+            connection.execute(
+                text(
+                    f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                    f"coalesce(max(id), 0) + 1, false) FROM {table}"
+                )
+            )
+        for table in (*COLUMNS, "vote_rollups"):
+            connection.execute(text(f"ANALYZE {table}"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--polls", type=int, default=20000)
+    parser.add_argument("--max-options", type=int, default=6)
+    parser.add_argument("--votes", type=int, default=1000000)
+    parser.add_argument("--owner-skew", type=float, default=3.0)
+    parser.add_argument("--poll-skew", type=float, default=1.1)
+    parser.add_argument("--option-skew", type=float, default=1.0)
+    parser.add_argument("--days", type=float, default=30)
+    parser.add_argument("--password", default="password")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--streams", type=int, default=4)
+    parser.add_argument("--truncate", action="store_true")
+    args = parser.parse_args()
+
+    bases = prepare(args)
+    polls = layout(args)
+    option_starts = [0, *accumulate(polls["counts"])]
+    vote_starts = [0, *accumulate(polls["voters"])]
+    context = {
+        "bases": bases,
+        "users": args.users,
+        "seed": args.seed,
+        "days": args.days,
+        "option_skew": args.option_skew,
+        "now": datetime.now(timezone.utc),
+        "hashed_password": pwd_context.hash(args.password),
+    }
+    user_shards = shards(args.users, args.streams)
+    poll_shards = shards(args.polls, args.streams)
+    tables = {
+        "users": [(user_rows, context, start, stop) for start, stop in user_shards],
+        "polls": [
+            (poll_rows, context, start, polls["owners"][start:stop])
+            for start, stop in poll_shards
+        ],
+        "options": [
+            (
+                option_rows,
+                context,
+                start,
+                polls["counts"][start:stop],
+                option_starts[start],
+            )
+            for start, stop in poll_shards
+        ],
+        "votes": [
+            (
+                vote_rows,
+                context,
+                start,
+                polls["counts"][start:stop],
+                polls["voters"][start:stop],
+                option_starts[start],
+                vote_starts[start],
+            )
+            for start, stop in poll_shards
+        ],
+    }
+    # Forked workers must not share the parent's pooled connections.
+    engine.dispose()
+    with ProcessPoolExecutor(args.streams) as executor:
+        for table, tasks in tables.items():
+            started = time.perf_counter()
+            futures = [executor.submit(copy_shard, table, *task) for task in tasks]
+            copied = sum(future.result() for future in futures)
+            print(f"{table}: {copied} rows in {time.perf_counter() - started:.1f} s")
+    started = time.perf_counter()
+    fix_up(bases)
+    print(f"fix-up: {time.perf_counter() - started:.1f} s")
+
+
+if __name__ == "__main__":
+    main()